@@ -0,0 +1,620 @@
+"""Offline benchmark for Mindcord's message pipeline.
+
+Replays generated or recorded traffic through main.on_message, the commands and
+the background tasks, with no Discord connection and with a stub in place of
+the Gemini model. Examples:
+
+    python bench.py --messages 5000 --users 2000 --guilds 20
+    python bench.py --preload-users 100000 --storage sqlite --messages 20000
+    python bench.py --messages 2000 --record traffic.jsonl
+    python bench.py --replay traffic.jsonl --latency 0.4 --failure-rate 0.1
+
+Everything is written to a temporary data directory, never to mindcord_data.
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import discord
+
+import main
+
+# Stand-ins for the discord.py objects the bot touches
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = False
+        self.dm_channel = None
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return self.id
+
+    async def create_dm(self):
+        if self.dm_channel is None:
+            self.dm_channel = FakeDMChannel(self.id + 10 ** 12, self)
+        return self.dm_channel
+
+class FakeClientUser(FakeUser):
+    """The bot's own account"""
+
+    def mentioned_in(self, message) -> bool:
+        if message.mention_everyone:
+            return True
+        return any(user.id == self.id for user in message.mentions)
+
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+class FakeSentMessage:
+    def __init__(self, channel, content: str):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content: str):
+        self.content = content
+        self.channel.stats['edits'] += 1
+        await asyncio.sleep(self.channel.send_latency)
+
+class ReplyClock:
+    """Time from each message to the first send of the reply that answers it.
+
+    main.generate_response is wrapped to note which message (or merged
+    turn) it is answering, and the fake channels' send() reports back, so
+    the time covers debouncing, batched decisions, queueing and generation.
+    """
+
+    answering = contextvars.ContextVar('answering', default=None)
+
+    def __init__(self, generate_response):
+        self.generate_response = generate_response
+        self.latencies = []
+
+    async def wrapped(self, message):
+        token = self.answering.set(message)
+        try:
+            await self.generate_response(message)
+        finally:
+            self.answering.reset(token)
+
+    def sent(self):
+        message = self.answering.get()
+        if message is None:
+            return
+        # Only the first send counts, e.g. the first chunk of a streamed reply
+        self.answering.set(None)
+        now = time.perf_counter()
+        for part in getattr(message, 'messages', [message]):
+            self.latencies.append(now - part.arrived)
+
+class SendMixin:
+    """send()/typing() for fake channels, counting what goes out"""
+
+    send_latency = 0.0
+    clock: Optional[ReplyClock] = None  # set while traffic replays
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content: Optional[str] = None, embed=None):
+        if self.clock:
+            self.clock.sent()
+        self.stats['sends'] += 1
+        self.stats['bytes'] += len(content or '')
+        await asyncio.sleep(self.send_latency)
+        return FakeSentMessage(self, content or '')
+
+class FakeTextChannel(SendMixin):
+    def __init__(self, channel_id: int, name: str, guild):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.stats = Counter()
+
+class FakeDMChannel(SendMixin, discord.DMChannel):
+    """Subclasses the real DMChannel so isinstance checks in main still work"""
+
+    def __init__(self, channel_id: int, recipient: FakeUser):
+        self.id = channel_id
+        self.recipients = [recipient]
+        self.stats = Counter()
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.members = []
+        self.text_channels = []
+        
+    def get_channel(self, channel_id: int):
+        return next((channel for channel in self.text_channels if channel.id == channel_id), None)
+
+class FakeMessage:
+    def __init__(self, message_id: int, author: FakeUser, channel, content: str,
+                 guild: Optional[FakeGuild] = None, mentions: Optional[list] = None):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.guild = guild
+        self.mentions = mentions or []
+        self.mention_everyone = False
+
+class FakeContext:
+    """Just enough of commands.Context for the command callbacks"""
+
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.author = message.author
+        self.guild = message.guild
+        self.channel = message.channel
+
+    async def send(self, content: Optional[str] = None, embed=None):
+        return await self.channel.send(content, embed=embed)
+
+# Stub model
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class StubStream:
+    def __init__(self, model, text: str):
+        self.model = model
+        self.text = text
+
+    def __aiter__(self):
+        return self.chunks()
+
+    async def chunks(self):
+        words = self.text.split(' ')
+        for start in range(0, len(words), 4):
+            await asyncio.sleep(self.model.latency() / 4)
+            yield StubResponse(' '.join(words[start:start + 4]) + ' ')
+
+class StubModel:
+    """Replaces genai.GenerativeModel with configurable latency and failure rate"""
+
+    def __init__(self, latency: float, jitter: float, failure_rate: float, rng: random.Random):
+        self.base_latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.calls = Counter()
+        self.prompt_chars = Counter()
+
+    def latency(self) -> float:
+        return max(0.0, self.base_latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def answer(self, prompt: str) -> tuple:
+        """Pick a plausible answer for the kind of prompt"""
+        if 'message numbers' in prompt:
+            return 'batch_decision', self.rng.choice(['1', '2', 'none', 'none'])
+        if '"yes" or "no"' in prompt:
+            return 'decision', self.rng.choice(['yes, sounds fun', 'no, not my thing'])
+        if 'CHANGE:' in prompt:
+            return 'mood', self.rng.choice(['STAY: chill', 'CHANGE: hyped'])
+        if 'conversation starter' in prompt:
+            return 'autonomous', 'yo, been a while, what are you up to'
+        return 'reply', 'lol yeah that makes sense, i was thinking the same thing honestly'
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs):
+        kind, text = self.answer(prompt)
+        self.calls[kind] += 1
+        self.prompt_chars[kind] += len(prompt)
+        if stream:
+            return StubStream(self, text)
+        await asyncio.sleep(self.latency())
+        if self.rng.random() < self.failure_rate:
+            raise RuntimeError('stub model failure')
+        return StubResponse(text)
+
+# Traffic
+
+WORDS = (
+    'lol gg anyone playing tonight that new update is wild what do you think about the patch '
+    'i just got home my internet is so slow does anyone know how to fix this honestly same '
+    'the raid was insane yesterday we should queue later this song slaps who made this meme'
+).split()
+
+def generate_traffic(args, rng: random.Random) -> List[dict]:
+    """Bursty synthetic traffic: each channel alternates quiet stretches and bursts"""
+    events = []
+    channels = [(guild, channel) for guild in range(args.guilds) for channel in range(args.channels_per_guild)]
+    t = 0.0
+    while len(events) < args.messages:
+        guild, channel = rng.choice(channels)
+        burst = rng.randint(1, args.max_burst) if rng.random() < args.burstiness else 1
+        user = rng.randrange(args.users)
+        for _ in range(burst):
+            if len(events) >= args.messages:
+                break
+
+            roll = rng.random()
+            if roll < args.command_rate:
+                content = rng.choice(['!mood', '!my_data', '!server_data', f'!remember i like {rng.choice(WORDS)}'])
+            else:
+                content = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 14)))
+
+            event = {
+                't': round(t, 4),
+                'user': user,
+                'guild': None if rng.random() < args.dm_rate else guild,
+                'channel': channel,
+                'content': content,
+                'mention': rng.random() < args.mention_rate
+            }
+            events.append(event)
+
+            # Same person often sends a few messages in a row
+            if rng.random() > 0.6:
+                user = rng.randrange(args.users)
+            t += rng.expovariate(args.rate * 4) if args.rate else 0
+        t += rng.expovariate(args.rate / 2) if args.rate else 0
+    return events
+
+class World:
+    """Registry of fake users, guilds and channels built lazily from traffic events"""
+
+    def __init__(self):
+        self.users = {}
+        self.guilds = {}
+        self.channels = {}
+        self.message_ids = iter(range(1, 10 ** 12))
+        self.bot_user = FakeClientUser(1, 'Mindcord')
+
+    def user(self, index: int) -> FakeUser:
+        user_id = 10 ** 6 + index
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = FakeUser(user_id, f'user{index}')
+        return user
+
+    def guild(self, index: int) -> FakeGuild:
+        guild_id = 10 ** 9 + index
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = FakeGuild(guild_id, f'guild{index}')
+            for position, name in enumerate(['general', 'gaming', 'memes', 'tech', 'serious', 'music', 'art', 'random']):
+                channel = FakeTextChannel(guild_id * 100 + position, name, guild)
+                guild.text_channels.append(channel)
+                self.channels[channel.id] = channel
+        return guild
+
+    def message(self, event: dict) -> FakeMessage:
+        author = self.user(event['user'])
+        if event['guild'] is None:
+            guild = None
+            channel = author.dm_channel or FakeDMChannel(author.id + 10 ** 12, author)
+            author.dm_channel = channel
+            self.channels[channel.id] = channel
+        else:
+            guild = self.guild(event['guild'])
+            channel = guild.text_channels[event['channel'] % len(guild.text_channels)]
+            if author not in guild.members:
+                guild.members.append(author)
+
+        mentions = [self.bot_user] if event['mention'] else []
+        content = f"<@{self.bot_user.id}> {event['content']}" if event['mention'] else event['content']
+        return FakeMessage(next(self.message_ids), author, channel, content, guild, mentions)
+
+# Setup
+
+def preload_users(memory, count: int, guilds: int, rng: random.Random):
+    """Write a dataset of `count` users straight into the backend"""
+    levels = ['new'] * 6 + ['acquaintance'] * 3 + ['friend', 'close_friend']
+    now = datetime.datetime.now()
+    users = {}
+    for index in range(count):
+        seen = now - datetime.timedelta(days=rng.randint(0, 400))
+        total = rng.randint(1, 200)
+        users[str(10 ** 6 + index)] = {
+            'name': f'user{index}',
+            'first_seen': seen.isoformat(),
+            'relationship_level': rng.choice(levels),
+            'conversation_topics': [],
+            'personality_notes': [],
+            'interests': [],
+            'communication_style': 'unknown',
+            'successful_interactions': [
+                {
+                    'timestamp': (seen + datetime.timedelta(minutes=n)).isoformat(),
+                    'user_message_length': rng.randint(2, 200),
+                    'bot_response_length': rng.randint(10, 200),
+                    'mood_used': rng.choice(main.MOODS),
+                    'relationship_level': 'new'
+                }
+                for n in range(rng.randint(0, 10))
+            ],
+            'my_personality_with_them': {},
+            'servers_shared': [str(10 ** 9 + rng.randrange(max(guilds, 1)))],
+            'last_seen': seen.isoformat(),
+            'total_interactions': total
+        }
+    memory.backend.save_records('users', users)
+
+def install(args, data_dir: str, world: World, rng: random.Random) -> StubModel:
+    """Point main's globals at the fakes and a fresh data directory"""
+    main.THINKING_DELAY = (args.thinking_delay, args.thinking_delay)
+    main.STREAM_RESPONSES = args.stream
+    main.METRICS_FILE = ''
+    main.metrics = main.Metrics()
+
+    main.memory = main.MindcordMemory(
+        data_dir, main.create_backend(data_dir, args.storage), background_writes=not args.sync_writes
+    )
+    main.response_gate = main.ResponseGate()
+    main.conversation_buffer = main.ConversationBuffer(
+        main.CONTEXT_TURNS_PER_CHANNEL, main.CONTEXT_MAX_MESSAGE_CHARS, main.CONTEXT_MAX_BYTES
+    )
+    main.decision_batcher = main.DecisionBatcher(
+        args.batch_window, main.DECISION_BATCH_MAX, main.DECISION_BATCH_REPLIES
+    )
+    main.message_debouncer = main.MessageDebouncer(
+        args.debounce_window, main.DEBOUNCE_MAX_WAIT, main.DEBOUNCE_MAX_MESSAGES
+    )
+    main.behavior_scheduler = main.BehaviorScheduler(main.SCHEDULER_JITTER)
+    ttls = {kind: 0 for kind in main.RESPONSE_CACHE_TTLS} if args.no_response_cache else main.RESPONSE_CACHE_TTLS
+    main.response_cache = main.ResponseCache(ttls, main.RESPONSE_CACHE_MAX_ENTRIES, main.RESPONSE_CACHE_MAX_BYTES)
+
+    stub = StubModel(args.latency, args.latency_jitter, args.failure_rate, rng)
+    main.model = stub
+    main.gemini = main.GeminiClient(
+        stub, args.concurrency, main.GEMINI_TIMEOUT, args.rpm, main.GEMINI_BURST, main.GEMINI_QUEUE_DEPTH
+    )
+
+    bot = main.bot
+    bot._connection.user = world.bot_user
+    bot.get_user = lambda user_id: world.users.get(user_id)
+    bot.get_guild = lambda guild_id: world.guilds.get(guild_id)
+
+    async def process_commands(message):
+        if not message.content.startswith(bot.command_prefix):
+            return
+        name, _, rest = message.content[len(bot.command_prefix):].partition(' ')
+        command = bot.get_command(name)
+        if command is None:
+            return
+        ctx = FakeContext(message)
+        if rest:
+            await command.callback(ctx, info=rest)
+        else:
+            await command.callback(ctx)
+    bot.process_commands = process_commands
+
+    return stub
+
+# Run
+
+async def replay(events: List[dict], world: World, args, errors: Counter):
+    """Feed events to on_message at their recorded offsets (scaled by --speed).
+
+    Returns how long on_message took for each message, and how long each
+    message that got a reply waited for it.
+    """
+    latencies = []
+    pending = set()
+    clock = SendMixin.clock = ReplyClock(main.generate_response)
+    main.generate_response = clock.wrapped
+
+    async def deliver(event):
+        message = world.message(event)
+        started = message.arrived = time.perf_counter()
+        try:
+            await main.on_message(message)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for event in events:
+        if args.speed:
+            delay = event['t'] / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        task = asyncio.create_task(deliver(event))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+        # Keep the number of messages being handled at once bounded
+        while len(pending) >= args.max_in_flight:
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    if pending:
+        await asyncio.wait(pending)
+
+    # Let merged turns, batched decisions and their replies finish
+    while (main.message_debouncer.pending or main.message_debouncer.tasks
+           or main.decision_batcher.pending or main.decision_batcher.tasks):
+        await asyncio.sleep(0.05)
+    main.generate_response = clock.generate_response
+    SendMixin.clock = None
+    return latencies, clock.latencies
+
+async def flush_periodically(interval: float):
+    """Run the memory_flush task the way its loop would while traffic plays"""
+    while True:
+        await asyncio.sleep(interval)
+        await main.memory_flush.coro()
+
+async def run_background_tasks() -> Dict[str, float]:
+    """Run each background task once and time it"""
+    timings = {}
+    personality = main.memory.get_personality()
+    personality['main_mood'] = 'social'
+    main.memory.save_personality(personality)
+    for name, run in [
+        ('personality_evolution', main.evolve_personality),
+        ('autonomous_conversation', main.start_autonomous_conversation),
+        ('memory_consolidation', main.memory_consolidation.coro),
+        ('memory_flush', main.memory.flush)
+    ]:
+        started = time.perf_counter()
+        result = run()
+        if asyncio.iscoroutine(result):
+            await result
+        timings[name] = time.perf_counter() - started
+    return timings
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(args, events, latencies, reply_latencies, elapsed, stub, world, task_timings, errors) -> dict:
+    counters = main.metrics.counters
+    bytes_read = sum(value for (name, _), value in counters.items() if name == 'storage_bytes_read_total')
+    bytes_written = sum(value for (name, _), value in counters.items() if name == 'storage_bytes_written_total')
+    sends = sum(channel.stats['sends'] for channel in world.channels.values())
+    edits = sum(channel.stats['edits'] for channel in world.channels.values())
+    llm_calls = sum(stub.calls.values())
+    lag = main.metrics.histograms.get(('event_loop_lag_seconds', ()))
+
+    return {
+        'messages': len(events),
+        'users': len(world.users),
+        'guilds': len(world.guilds),
+        'storage': args.storage,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(len(events) / elapsed, 1) if elapsed else 0,
+        # Message to the first send of its reply, through the whole pipeline
+        'reply_p50_ms': round(percentile(reply_latencies, 0.5) * 1000, 2),
+        'reply_p99_ms': round(percentile(reply_latencies, 0.99) * 1000, 2),
+        'messages_replied_to': len(reply_latencies),
+        # on_message alone: decisions and replies run in background tasks after it returns
+        'on_message_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'on_message_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'llm_calls': llm_calls,
+        'llm_calls_per_message': round(llm_calls / len(events), 4) if events else 0,
+        'llm_calls_by_kind': dict(stub.calls),
+        'avg_prompt_chars_by_kind': {kind: round(stub.prompt_chars[kind] / count) for kind, count in stub.calls.items()},
+        'llm_calls_saved_by_prefilter': main.response_gate.llm_calls_saved(),
+        'response_cache': dict(main.response_cache.stats),
+        'debounce': dict(main.message_debouncer.stats),
+        'scheduled_targets': len(main.behavior_scheduler.due),
+        'discord_sends': sends,
+        'discord_edits': edits,
+        'storage_bytes_read': int(bytes_read),
+        'storage_bytes_written': int(bytes_written),
+        'storage_writer': dict(main.memory.writer.stats) if main.memory.writer else {},
+        'event_loop_lag_ms': {
+            'p99': round(lag.quantile(0.99) * 1000, 2) if lag else 0,
+            'max': round(main.loop_lag_monitor.max_lag * 1000, 2)
+        },
+        'background_task_seconds': {name: round(value, 4) for name, value in task_timings.items()},
+        'errors': dict(errors)
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000, help='messages to generate')
+    parser.add_argument('--users', type=int, default=500, help='distinct users sending messages')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--channels-per-guild', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=200, help='average generated messages per second')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed multiplier, 0 = as fast as possible')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='messages handled at once')
+    parser.add_argument('--burstiness', type=float, default=0.4, help='chance that a channel gets a burst')
+    parser.add_argument('--max-burst', type=int, default=8)
+    parser.add_argument('--mention-rate', type=float, default=0.05)
+    parser.add_argument('--dm-rate', type=float, default=0.02)
+    parser.add_argument('--command-rate', type=float, default=0.03)
+    parser.add_argument('--preload-users', type=int, default=0, help='users written to storage before the run')
+    parser.add_argument('--storage', choices=['json', 'sqlite', 'journal'], default=main.STORAGE_BACKEND)
+    parser.add_argument('--sync-writes', action='store_true', help='write storage on the event loop, not the writer thread')
+    parser.add_argument('--flush-every', type=float, default=1.0, help='seconds between memory_flush runs during replay')
+    parser.add_argument('--lag-interval', type=float, default=0.01, help='event loop lag sampling interval in seconds')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub model latency in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=main.GEMINI_MAX_CONCURRENCY)
+    parser.add_argument('--rpm', type=float, default=0, help='Gemini requests per minute, 0 = no limit')
+    parser.add_argument('--debounce-window', type=float, default=main.DEBOUNCE_WINDOW, help='0 = answer every message on its own')
+    parser.add_argument('--batch-window', type=float, default=main.DECISION_BATCH_WINDOW)
+    parser.add_argument('--no-response-cache', action='store_true', help='turn the model answer cache off')
+    parser.add_argument('--thinking-delay', type=float, default=0.0)
+    parser.add_argument('--stream', action='store_true', help='use streaming replies')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--record', help='write the generated traffic to this JSONL file')
+    parser.add_argument('--replay', help='replay traffic from this JSONL file instead of generating it')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--keep-data', action='store_true', help="don't delete the temporary data directory")
+    return parser.parse_args(argv)
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+
+    if args.replay:
+        with open(args.replay) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = generate_traffic(args, rng)
+    if args.record:
+        with open(args.record, 'w') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+    data_dir = tempfile.mkdtemp(prefix='mindcord_bench_')
+    try:
+        world = World()
+        stub = install(args, data_dir, world, rng)
+        if args.preload_users:
+            started = time.perf_counter()
+            preload_users(main.memory, args.preload_users, args.guilds, rng)
+            print(f'preloaded {args.preload_users} users in {time.perf_counter() - started:.2f}s', file=sys.stderr)
+
+            # Start from disk like a restarted bot would
+            main.memory.close()
+            main.metrics = main.Metrics()
+            main.memory = main.MindcordMemory(
+                data_dir, main.create_backend(data_dir, args.storage), background_writes=not args.sync_writes
+            )
+        main.init_personality()
+        await main.memory.build_indexes()
+
+        errors = Counter()
+        main.loop_lag_monitor = main.LoopLagMonitor(args.lag_interval)
+        main.loop_lag_monitor.start()
+        flusher = asyncio.create_task(flush_periodically(args.flush_every))
+        started = time.perf_counter()
+        latencies, reply_latencies = await replay(events, world, args, errors)
+        elapsed = time.perf_counter() - started
+        flusher.cancel()
+        main.loop_lag_monitor.stop()
+
+        task_timings = await run_background_tasks()
+        await main.memory.aclose()
+        return report(args, events, latencies, reply_latencies, elapsed, stub, world, task_timings, errors)
+    finally:
+        if args.keep_data:
+            print(f'data left in {data_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(run(args))
+    for key, value in result.items():
+        print(f'{key}: {value}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
\ No newline at end of file
@@ -5,21 +5,774 @@ import json
 import os
 import datetime
 import random
+import re
 import asyncio
+import contextlib
+import bisect
+import functools
+import heapq
+import inspect
+import itertools
+import math
+import mmap
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict, deque
 from typing import Dict, List, Optional
 
 # Configuration
 TOKEN = os.getenv('DISCORD_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# Memory cache: dirty records are written back after this many seconds,
+# or as soon as this many records are waiting
+MEMORY_FLUSH_INTERVAL = float(os.getenv('MINDCORD_FLUSH_INTERVAL', '30'))
+MEMORY_FLUSH_MAX_DIRTY = int(os.getenv('MINDCORD_FLUSH_MAX_DIRTY', '200'))
+
+# Storage engine for memory records: 'json', 'sqlite' or 'journal'
+STORAGE_BACKEND = os.getenv('MINDCORD_STORAGE', 'json')
+
+# Storage writes run on one background thread instead of the event loop. Changes
+# to a record still waiting there are written once, and flushes and consolidation
+# wait (off the event loop) once this many changes are waiting
+STORAGE_WRITER = os.getenv('MINDCORD_STORAGE_WRITER', '1') == '1'
+STORAGE_WRITER_MAX_PENDING = int(os.getenv('MINDCORD_STORAGE_WRITER_MAX_PENDING', '20000'))
+# At shutdown, how long to wait for the last writes and how often to retry a failing one before dropping it
+STORAGE_WRITER_CLOSE_TIMEOUT = float(os.getenv('MINDCORD_STORAGE_WRITER_CLOSE_TIMEOUT', '30'))
+STORAGE_WRITER_CLOSE_RETRIES = int(os.getenv('MINDCORD_STORAGE_WRITER_CLOSE_RETRIES', '3'))
+
+# How often the event loop checks how late it wakes up, which is how long it was blocked (seconds)
+LOOP_LAG_INTERVAL = float(os.getenv('MINDCORD_LOOP_LAG_INTERVAL', '0.5'))
+
+# Journal storage: compact the journal into the snapshot once it reaches this size,
+# and at boot refuse to leave more than this much journal to replay next time (bytes)
+JOURNAL_COMPACT_BYTES = int(os.getenv('MINDCORD_JOURNAL_COMPACT_BYTES', str(16 * 1024 * 1024)))
+JOURNAL_MAX_REPLAY_BYTES = int(os.getenv('MINDCORD_JOURNAL_MAX_REPLAY_BYTES', str(64 * 1024 * 1024)))
+JOURNAL_FSYNC = os.getenv('MINDCORD_JOURNAL_FSYNC', '0') == '1'  # fsync every append, not just on compaction
+
+# Sharding: MINDCORD_SHARD_COUNT > 0 runs the gateway as an AutoShardedBot with that
+# many shards, of which this process runs MINDCORD_SHARD_IDS (default: all of them).
+# MINDCORD_WORKERS > 1 turns `python main.py` into a launcher that starts that many
+# worker processes, splits the shards and the Gemini quota between them, and
+# points them all at the shared SQLite store
+SHARD_COUNT = int(os.getenv('MINDCORD_SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard) for shard in os.getenv('MINDCORD_SHARD_IDS', '').split(',') if shard]
+WORKERS = int(os.getenv('MINDCORD_WORKERS', '1'))
+WORKER_INDEX = os.getenv('MINDCORD_WORKER_INDEX', '')
+
+# Set on every process using a store other processes also write to: the memory
+# cache then writes through and rereads, and background jobs run on one leader,
+# whoever holds the lease (seconds)
+SHARED_STORAGE = os.getenv('MINDCORD_SHARED_STORAGE', '0') == '1'
+LEADER_LEASE_SECONDS = float(os.getenv('MINDCORD_LEADER_LEASE', '30'))
+# How long an SQLite write may block the event loop waiting on another process's
+# write lock, and how long a read-modify-write keeps retrying for it without
+# blocking (seconds)
+SQLITE_BUSY_TIMEOUT = float(os.getenv('MINDCORD_SQLITE_BUSY_TIMEOUT', '0.25'))
+SQLITE_LOCK_WAIT = float(os.getenv('MINDCORD_SQLITE_LOCK_WAIT', '5'))
+
+# Gemini: how many requests may be in flight at once, and how long one may take (seconds)
+GEMINI_MAX_CONCURRENCY = int(os.getenv('MINDCORD_GEMINI_CONCURRENCY', '4'))
+GEMINI_TIMEOUT = float(os.getenv('MINDCORD_GEMINI_TIMEOUT', '20'))
+
+# Gemini quota: sustained requests per minute and how many may go out in a burst (0 = no limit)
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv('MINDCORD_GEMINI_RPM', '15'))
+GEMINI_BURST = int(os.getenv('MINDCORD_GEMINI_BURST', '5'))
+GEMINI_QUEUE_DEPTH = int(os.getenv('MINDCORD_GEMINI_QUEUE_DEPTH', '100'))  # waiting requests across all priorities
+
+# Circuit breaker: trips when too many of the last calls failed or were slow,
+# then lets a single probe through after the cooldown (seconds)
+BREAKER_WINDOW = int(os.getenv('MINDCORD_BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('MINDCORD_BREAKER_MIN_CALLS', '5'))
+BREAKER_ERROR_RATE = float(os.getenv('MINDCORD_BREAKER_ERROR_RATE', '0.5'))
+BREAKER_SLOW_CALL = float(os.getenv('MINDCORD_BREAKER_SLOW_CALL', '10'))
+BREAKER_SLOW_RATE = float(os.getenv('MINDCORD_BREAKER_SLOW_RATE', '0.8'))
+BREAKER_COOLDOWN = float(os.getenv('MINDCORD_BREAKER_COOLDOWN', '30'))
+
+# Stream replies into Discord as they're generated, editing the message at most
+# once per interval (Discord allows about 5 edits per 5 seconds)
+STREAM_RESPONSES = os.getenv('MINDCORD_STREAM_RESPONSES', '0') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('MINDCORD_STREAM_EDIT_INTERVAL', '1.2'))
+
+# Random "thinking" pause before a reply goes out, in seconds (min,max)
+THINKING_DELAY = tuple(float(part) for part in os.getenv('MINDCORD_THINKING_DELAY', '1,3').split(','))
+
+# Recent messages kept per channel for prompt context, with a cap on the total
+# estimated size; idle channels are dropped first when it's exceeded
+CONTEXT_TURNS_PER_CHANNEL = int(os.getenv('MINDCORD_CONTEXT_TURNS', '20'))
+CONTEXT_PROMPT_TURNS = int(os.getenv('MINDCORD_CONTEXT_PROMPT_TURNS', '8'))  # how many go into a prompt
+CONTEXT_MAX_MESSAGE_CHARS = int(os.getenv('MINDCORD_CONTEXT_MESSAGE_CHARS', '300'))
+CONTEXT_MAX_BYTES = int(os.getenv('MINDCORD_CONTEXT_MAX_BYTES', str(8 * 1024 * 1024)))
+
+# !remember memories: the most relevant few go into reply prompts within a
+# character budget; each user's search index covers their most recent memories,
+# and only so many users' indexes are kept, least recently used dropped first
+RETRIEVAL_TOP_K = int(os.getenv('MINDCORD_RETRIEVAL_TOP_K', '3'))
+RETRIEVAL_PROMPT_CHARS = int(os.getenv('MINDCORD_RETRIEVAL_PROMPT_CHARS', '600'))
+RETRIEVAL_MAX_MEMORIES = int(os.getenv('MINDCORD_RETRIEVAL_MAX_MEMORIES', '1000'))
+RETRIEVAL_CACHED_USERS = int(os.getenv('MINDCORD_RETRIEVAL_CACHED_USERS', '200'))
+
+# Prompt size budget per call type, in characters; when a prompt would be
+# bigger, its least important context is trimmed first
+PROMPT_BUDGETS = {
+    kind: int(os.getenv(f'MINDCORD_PROMPT_BUDGET_{kind.upper()}', str(default)))
+    for kind, default in (
+        ('reply', 3000), ('decision', 1500), ('batch_decision', 2500), ('mood', 1200), ('autonomous', 800)
+    )
+}
+PROMPT_MESSAGE_CHARS = int(os.getenv('MINDCORD_PROMPT_MESSAGE_CHARS', '1000'))  # longest message quoted in a prompt
+
+# Model answers are reused for this long (seconds) when a call's inputs repeat,
+# e.g. a mood check with nothing changed or the same "lol" from the same person
+# after the same conversation (0 turns caching off for that kind); identical
+# calls in flight share one request. Replies are off by default: their prompt
+# changes with every message, so a reuse would hardly ever be right
+RESPONSE_CACHE_TTLS = {
+    kind: float(os.getenv(f'MINDCORD_CACHE_TTL_{kind.upper()}', str(default)))
+    for kind, default in (('decision', 120), ('batch_decision', 60), ('mood', 3 * 3600), ('reply', 0))
+}
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('MINDCORD_CACHE_MAX_ENTRIES', '5000'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('MINDCORD_CACHE_MAX_BYTES', str(2 * 1024 * 1024)))
+
+# Metrics are written in Prometheus text format for node exporter's textfile
+# collector every interval (seconds); an empty path turns the file off
+METRICS_FILE = os.getenv('MINDCORD_METRICS_FILE', 'mindcord_data/mindcord.prom')
+METRICS_EXPORT_INTERVAL = float(os.getenv('MINDCORD_METRICS_INTERVAL', '60'))
+
+# Gemini request priorities, most urgent first
+PRIORITY_MENTION = 0
+PRIORITY_DM = 1
+PRIORITY_REPLY = 2
+PRIORITY_DECISION = 3
+PRIORITY_BACKGROUND = 4
+
+PRIORITY_NAMES = {
+    PRIORITY_MENTION: 'mention',
+    PRIORITY_DM: 'dm',
+    PRIORITY_REPLY: 'reply',
+    PRIORITY_DECISION: 'decision',
+    PRIORITY_BACKGROUND: 'background'
+}
+
+# Most requests of each priority allowed to wait for a slot
+GEMINI_QUEUE_LIMITS = {
+    PRIORITY_MENTION: 50,
+    PRIORITY_DM: 50,
+    PRIORITY_REPLY: 20,
+    PRIORITY_DECISION: 10,
+    PRIORITY_BACKGROUND: 2
+}
+
+# Local pre-filter in front of the "should I respond?" call
+GATE_MIN_CHARS = int(os.getenv('MINDCORD_GATE_MIN_CHARS', '4'))  # letters/digits left after stripping emoji and links
+GATE_COOLDOWN = float(os.getenv('MINDCORD_GATE_COOLDOWN', '20'))  # seconds of quiet after replying in a channel
+GATE_CHANNEL_BUDGET = int(os.getenv('MINDCORD_GATE_CHANNEL_BUDGET', '6'))  # ambient replies per channel per window
+GATE_BUDGET_WINDOW = float(os.getenv('MINDCORD_GATE_BUDGET_WINDOW', '600'))
+GATE_SAMPLE_RATE = float(os.getenv('MINDCORD_GATE_SAMPLE_RATE', '1.0'))  # scales how many messages reach the LLM
+
+# Quick consecutive messages from one person in a channel are merged into one
+# turn before anything decides on a reply (0 turns merging off)
+DEBOUNCE_WINDOW = float(os.getenv('MINDCORD_DEBOUNCE_WINDOW', '1.5'))  # seconds of quiet that end a turn
+DEBOUNCE_MAX_WAIT = float(os.getenv('MINDCORD_DEBOUNCE_MAX_WAIT', '6'))  # longest a turn is held back
+DEBOUNCE_MAX_MESSAGES = int(os.getenv('MINDCORD_DEBOUNCE_MAX_MESSAGES', '8'))
+
+# Reply decisions are batched per channel: messages arriving within the window
+# share one LLM call (0 turns batching off)
+DECISION_BATCH_WINDOW = float(os.getenv('MINDCORD_DECISION_BATCH_WINDOW', '2.5'))
+DECISION_BATCH_MAX = int(os.getenv('MINDCORD_DECISION_BATCH_MAX', '10'))  # decide early once this many are waiting
+DECISION_BATCH_REPLIES = int(os.getenv('MINDCORD_DECISION_BATCH_REPLIES', '1'))  # most replies per batch
+
+# Memory consolidation walks this many users and servers per run, so a full
+# pass over a big dataset is spread out instead of done in one go
+CONSOLIDATION_INTERVAL = float(os.getenv('MINDCORD_CONSOLIDATION_INTERVAL', '60'))
+CONSOLIDATION_BATCH = int(os.getenv('MINDCORD_CONSOLIDATION_BATCH', '500'))
+
+# Mood changes and reaching out to friends run off a timer heap fed by
+# activity instead of fixed loops. Every due time gets this much random
+# jitter either way, so targets scheduled together don't all fire together
+SCHEDULER_JITTER = float(os.getenv('MINDCORD_SCHEDULER_JITTER', '0.2'))
+# The mood is reconsidered this often, sooner once this many messages came in,
+# and skipped without asking Gemini when nothing came in at all
+MOOD_INTERVAL = float(os.getenv('MINDCORD_MOOD_INTERVAL', '3600'))
+MOOD_MIN_INTERVAL = float(os.getenv('MINDCORD_MOOD_MIN_INTERVAL', '900'))
+MOOD_ACTIVITY_TRIGGER = int(os.getenv('MINDCORD_MOOD_ACTIVITY_TRIGGER', '500'))
+# A friend is messaged after being quiet this long, and the bot starts at most
+# one conversation per gap (the old 10% every 30 minutes was one per 5 hours)
+OUTREACH_QUIET = float(os.getenv('MINDCORD_OUTREACH_QUIET', str(24 * 3600)))
+OUTREACH_MIN_GAP = float(os.getenv('MINDCORD_OUTREACH_MIN_GAP', str(5 * 3600)))
+OUTREACH_LEVELS = ['close_friend', 'friend', 'creator']
+SOCIAL_MOODS = ['social', 'chatty', 'hyped', 'bored', 'excited']
+
+# Retention: users at these levels not seen for this many days are forgotten
+# (0 days keeps everyone), as are servers the bot has left and not heard from
+RETENTION_DORMANT_DAYS = float(os.getenv('MINDCORD_RETENTION_DORMANT_DAYS', '180'))
+RETENTION_DORMANT_LEVELS = os.getenv('MINDCORD_RETENTION_DORMANT_LEVELS', 'new,acquaintance').split(',')
+RETENTION_INTERACTION_DAYS = float(os.getenv('MINDCORD_RETENTION_INTERACTION_DAYS', '7'))  # older ones are summarized
+RETENTION_MAX_INTERACTIONS = int(os.getenv('MINDCORD_RETENTION_MAX_INTERACTIONS', '50'))
+RETENTION_MAX_CUSTOM_MEMORIES = int(os.getenv('MINDCORD_RETENTION_MAX_CUSTOM_MEMORIES', '100'))
+RETENTION_MAX_SERVERS_SHARED = int(os.getenv('MINDCORD_RETENTION_MAX_SERVERS_SHARED', '50'))
+RETENTION_MOOD_HISTORY_DAYS = float(os.getenv('MINDCORD_RETENTION_MOOD_HISTORY_DAYS', '30'))
+
+class Histogram:
+    """Fixed-bucket latency histogram, cheap enough for the hot path"""
+    
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        
+    def quantile(self, fraction: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket, like Prometheus does"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.BUCKETS[index - 1] if index else 0.0
+                if index == len(self.BUCKETS):
+                    return lower
+                upper = self.BUCKETS[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.BUCKETS[-1]
+
+class Metrics:
+    """Counters, gauges and latency histograms keyed by name and labels"""
+    
+    def __init__(self):
+        self.counters = Counter()  # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {}
+        # Workers label everything they export so their files don't collide
+        self.constant_labels = [('worker', WORKER_INDEX)] if WORKER_INDEX else []
+        
+    def count(self, name: str, amount: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+        
+    def set_counter(self, name: str, value: float, **labels):
+        """Copy in a total that some component already keeps"""
+        self.counters[(name, tuple(sorted(labels.items())))] = value
+        
+    def gauge(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+        
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+        
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """Time a block as one pipeline stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=stage)
+            
+    @contextlib.contextmanager
+    def task_timer(self, task: str):
+        """Time one run of a background task"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('task_seconds', time.perf_counter() - started, task=task)
+            
+    def render(self) -> str:
+        """Everything in Prometheus text exposition format"""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + self.constant_labels + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+        
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE mindcord_{name} {kind}')
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append(f'mindcord_{name}{label_text(labels)} {value}')
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f'mindcord_{name}{label_text(labels)} {value}')
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(Histogram.BUCKETS) + ['+Inf'], histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'mindcord_{name}_bucket{label_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'mindcord_{name}_sum{label_text(labels)} {histogram.sum}')
+            lines.append(f'mindcord_{name}_count{label_text(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+        
+    def write_file(self, path: str):
+        """Write the textfile atomically so the exporter never reads half of it"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
+
+class LoopLagMonitor:
+    """Sleeps in a loop and measures how late it wakes up: time the event loop spent blocked"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.task = None
+        self.max_lag = 0.0
+        
+    def start(self):
+        """Start watching, unless already running (on_ready fires again after reconnects)"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.watch())
+            
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            
+    async def watch(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            metrics.observe('event_loop_lag_seconds', lag)
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
 # Initialize Gemini
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-1.5-flash')
 
+class GeminiOverloaded(Exception):
+    """A request was turned away to keep room for more urgent ones"""
+    pass
+
+class GeminiUnavailable(Exception):
+    """The circuit breaker is open, so the model isn't being called at all"""
+    pass
+
+class CircuitBreaker:
+    """Stops calling Gemini while it's failing or slow, probing now and then to see if it's back"""
+    
+    def __init__(self, window: int, min_calls: int, error_rate: float,
+                 slow_call: float, slow_rate: float, cooldown: float):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        
+        self.results = deque(maxlen=window)  # (succeeded, latency) of recent calls
+        self.state = 'closed'
+        self.generation = 0  # bumped on every state change, so late results from before it are ignored
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.ignored = 0  # results that came back from before the last state change
+        
+    def available(self) -> bool:
+        """Whether a call made now would be let through"""
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at >= self.cooldown
+        if self.state == 'half_open':
+            return not self.probing
+        return True
+        
+    def allow_request(self) -> Optional[tuple]:
+        """Claim permission for a call, starting a probe if the cooldown is over.
+        
+        Returns the ticket to hand to record() or release_probe(), or None if
+        the call isn't allowed.
+        """
+        if not self.available():
+            return None
+        if self.state == 'open':
+            self.set_state('half_open')
+        probe = self.state == 'half_open'
+        if probe:
+            self.probing = True
+        return self.generation, probe
+        
+    def release_probe(self, ticket: tuple):
+        """A call ended without reaching the model; if it was the probe, let another one try"""
+        generation, probe = ticket
+        if probe and generation == self.generation:
+            self.probing = False
+            
+    def record(self, ticket: tuple, succeeded: bool, latency: float):
+        """Count the outcome of a call and open or close the breaker"""
+        generation, probe = ticket
+        if generation != self.generation:
+            # Started before the breaker last opened or closed, so it says nothing about now
+            self.ignored += 1
+            return
+            
+        if probe:
+            self.probing = False
+            if succeeded and latency < self.slow_call:
+                self.set_state('closed')
+            else:
+                self.trip()
+            return
+        
+        self.results.append((succeeded, latency))
+        if len(self.results) < self.min_calls:
+            return
+        failures = sum(1 for ok, _ in self.results if not ok)
+        slow = sum(1 for _, latency in self.results if latency >= self.slow_call)
+        if (failures / len(self.results) >= self.error_rate
+                or slow / len(self.results) >= self.slow_rate):
+            self.trip()
+            
+    def set_state(self, state: str):
+        self.state = state
+        self.generation += 1
+        self.results.clear()
+        
+    def trip(self):
+        self.set_state('open')
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        print(f'⚡ Gemini circuit breaker opened, retrying in {self.cooldown:.0f}s')
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+    def wait_time(self) -> float:
+        """Seconds until a token is available"""
+        if self.rate <= 0:
+            return 0.0
+        self.refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+        
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+class GeminiClient:
+    """Schedules every model call by priority within our quota, without blocking the event loop"""
+    
+    def __init__(self, model, max_concurrency: int, timeout: float,
+                 requests_per_minute: float, burst: int, queue_depth: int):
+        self.model = model
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.queue_depth = queue_depth
+        
+        self.queue = []  # heap of (priority, sequence, future)
+        self.queued = Counter()  # priority -> waiting requests
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.stats = Counter()
+        self.breaker = CircuitBreaker(
+            BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE,
+            BREAKER_SLOW_CALL, BREAKER_SLOW_RATE, BREAKER_COOLDOWN
+        )
+        
+    def available(self) -> bool:
+        """False while the circuit breaker is keeping calls away from Gemini"""
+        return self.breaker.available()
+        
+    def can_start(self) -> bool:
+        return self.in_flight < self.max_concurrency and self.bucket.wait_time() == 0
+        
+    def shed_for(self, priority: int) -> bool:
+        """Drop the least urgent waiting request to make room, if it's less urgent than `priority`"""
+        waiting = [entry for entry in self.queue if not entry[2].done() and entry[0] > priority]
+        if not waiting:
+            return False
+        victim = max(waiting)
+        victim[2].set_exception(GeminiOverloaded(f'shed for a {PRIORITY_NAMES[priority]} request'))
+        self.stats[f'shed_{PRIORITY_NAMES[victim[0]]}'] += 1
+        return True
+        
+    async def acquire(self, priority: int):
+        """Wait for a request slot and a quota token"""
+        if not self.queue and self.can_start():
+            self.bucket.take()
+            self.in_flight += 1
+            return
+        
+        if self.queued[priority] >= GEMINI_QUEUE_LIMITS[priority] or (
+                sum(self.queued.values()) >= self.queue_depth and not self.shed_for(priority)):
+            self.stats[f'rejected_{PRIORITY_NAMES[priority]}'] += 1
+            raise GeminiOverloaded(f'{PRIORITY_NAMES[priority]} queue is full')
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.sequence), future))
+        self.queued[priority] += 1
+        future.add_done_callback(lambda _: self.queued.subtract([priority]))
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been granted just as we gave up waiting
+            if not future.done():
+                future.cancel()
+                self.stats[f'expired_{PRIORITY_NAMES[priority]}'] += 1
+                raise GeminiOverloaded(f'{PRIORITY_NAMES[priority]} request waited too long')
+            if future.exception():
+                raise future.exception()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            future.cancel()
+            raise
+            
+    def release(self):
+        self.in_flight -= 1
+        self.wakeup.set()
+        
+    async def dispatch(self):
+        """Hand out slots to waiting requests, most urgent first"""
+        try:
+            while self.queue:
+                if self.queue[0][2].done():
+                    heapq.heappop(self.queue)
+                    continue
+                
+                if self.in_flight >= self.max_concurrency:
+                    delay = None
+                else:
+                    delay = self.bucket.wait_time()
+                    if delay == 0:
+                        priority, _, future = heapq.heappop(self.queue)
+                        self.bucket.take()
+                        self.in_flight += 1
+                        future.set_result(None)
+                        continue
+                
+                # Sleep until a request finishes or the bucket refills
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.dispatcher = None
+            
+    def count_call(self, priority: int, prompt: str):
+        """Count a model call and roughly how many tokens it sends (about 4 characters each)"""
+        metrics.count('llm_calls_total', priority=PRIORITY_NAMES[priority])
+        metrics.count('llm_prompt_tokens_estimate_total', len(prompt) // 4, priority=PRIORITY_NAMES[priority])
+        
+    async def begin(self, priority: int):
+        """Count a request, check the breaker and wait for a slot; returns the breaker's ticket"""
+        self.stats[f'requests_{PRIORITY_NAMES[priority]}'] += 1
+        ticket = self.breaker.allow_request()
+        if ticket is None:
+            self.stats['breaker_rejected'] += 1
+            raise GeminiUnavailable('gemini circuit breaker is open')
+        
+        try:
+            await self.acquire(priority)
+        except BaseException:
+            self.breaker.release_probe(ticket)
+            raise
+        return ticket
+            
+    async def generate(self, prompt: str, priority: int = PRIORITY_BACKGROUND,
+                       timeout: Optional[float] = None) -> str:
+        """Generate text for a prompt.
+        
+        Raises GeminiUnavailable while the circuit breaker is open, GeminiOverloaded
+        if the request is shed, or asyncio.TimeoutError if the model takes too long.
+        """
+        ticket = await self.begin(priority)
+        self.count_call(priority, prompt)
+        
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(prompt),
+                timeout or self.timeout
+            )
+        except asyncio.CancelledError:
+            self.breaker.release_probe(ticket)
+            raise
+        except Exception:
+            self.breaker.record(ticket, False, time.monotonic() - started)
+            raise
+        finally:
+            self.release()
+        
+        self.breaker.record(ticket, True, time.monotonic() - started)
+        text = response.text
+        metrics.count('llm_output_tokens_estimate_total', len(text) // 4, priority=PRIORITY_NAMES[priority])
+        return text
+        
+    async def stream(self, prompt: str, priority: int = PRIORITY_BACKGROUND,
+                     timeout: Optional[float] = None):
+        """Yield the response text in chunks as the model produces them.
+        
+        Raises the same errors as generate(); the timeout applies to each chunk.
+        """
+        ticket = await self.begin(priority)
+        self.count_call(priority, prompt)
+        timeout = timeout or self.timeout
+        
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(prompt, stream=True),
+                timeout
+            )
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                metrics.count('llm_output_tokens_estimate_total', len(chunk.text) // 4, priority=PRIORITY_NAMES[priority])
+                yield chunk.text
+        except (asyncio.CancelledError, GeneratorExit):
+            self.breaker.release_probe(ticket)
+            raise
+        except Exception:
+            self.breaker.record(ticket, False, time.monotonic() - started)
+            raise
+        finally:
+            self.release()
+        
+        self.breaker.record(ticket, True, time.monotonic() - started)
+
+gemini = GeminiClient(
+    model, GEMINI_MAX_CONCURRENCY, GEMINI_TIMEOUT,
+    GEMINI_REQUESTS_PER_MINUTE, GEMINI_BURST, GEMINI_QUEUE_DEPTH
+)
+
+def normalize_text(text: str) -> str:
+    """Message text reduced for cache keys: case, spacing and stretched letters don't matter"""
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+    return re.sub(r'(.)\1{2,}', r'\1\1', text)
+
+class ResponseCache:
+    """LRU cache of model answers keyed on a call's normalized inputs, with a TTL per kind.
+    
+    A miss starts the call as its own task, and identical calls arriving
+    while it runs wait on that task instead of sending their own. Entries
+    are evicted oldest first past a count and an estimated size.
+    """
+    
+    # Rough per-entry cost of the key tuple, the dict slot and the expiry
+    ENTRY_OVERHEAD = 200
+    
+    def __init__(self, ttls: Dict[str, float], max_entries: int, max_bytes: int):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (kind, key) -> (expires, text), least recently used first
+        self.in_flight = {}  # (kind, key) -> task
+        self.size = 0
+        self.stats = Counter()
+        
+    def entry_size(self, key: tuple, text: str) -> int:
+        return self.ENTRY_OVERHEAD + len(repr(key)) + len(text)
+        
+    async def get(self, kind: str, key: tuple, call) -> str:
+        """The cached answer for these inputs, or the answer of call(), shared with identical callers"""
+        ttl = self.ttls.get(kind, 0)
+        if ttl <= 0:
+            return await call()
+            
+        key = (kind, key)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.count(kind, 'hit')
+                return entry[1]
+            self.remove(key)
+            
+        task = self.in_flight.get(key)
+        if task is None:
+            self.count(kind, 'miss')
+            task = self.in_flight[key] = asyncio.ensure_future(self.fill(key, ttl, call))
+            # Nobody may be left waiting to see a failure
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        else:
+            self.count(kind, 'coalesced')
+        # A caller giving up doesn't cancel the call for the others
+        return await asyncio.shield(task)
+        
+    async def fill(self, key: tuple, ttl: float, call) -> str:
+        try:
+            text = await call()
+        finally:
+            del self.in_flight[key]
+        self.put(key, text, ttl)
+        return text
+        
+    def put(self, key: tuple, text: str, ttl: float):
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (time.monotonic() + ttl, text)
+        self.size += self.entry_size(key, text)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+            self.stats['evicted'] += 1
+            
+    def remove(self, key: tuple):
+        _, text = self.entries.pop(key)
+        self.size -= self.entry_size(key, text)
+        
+    def count(self, kind: str, outcome: str):
+        self.stats[f'{outcome}_{kind}'] += 1
+        metrics.count('response_cache_total', kind=kind, outcome=outcome)
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTLS, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
 
 # Human-like moods
 MOODS = [
@@ -32,6 +785,14 @@ MOODS = [
     'nostalgic', 'creative', 'brain-dead', 'vibing'
 ]
 
+# Canned replies for when the model can't answer
+ERROR_RESPONSES = [
+    "my brain just lagged for a sec",
+    "sorry, processing error lol",
+    "uh, that broke something in my head",
+    "technical difficulties, one moment"
+]
+
 # Channel contexts
 CHANNEL_CONTEXTS = {
     'general': 'casual conversation',
@@ -43,63 +804,1942 @@ CHANNEL_CONTEXTS = {
     'art': 'art and creative content'
 }
 
-class MindcordMemory:
+# Relationship levels the bot hands out, in order
+RELATIONSHIP_LEVELS = ['new', 'acquaintance', 'friend', 'close_friend', 'creator']
+
+# Compact records: the memory layer keeps users, servers and the personality in
+# these instead of the dicts they're stored as
+
+MISSING = object()
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+def to_epoch(timestamp) -> Optional[int]:
+    """Microseconds since 1970 for a naive ISO timestamp, if they turn back into exactly the same text"""
+    if type(timestamp) is not str:
+        return None
+    try:
+        moment = datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None or moment.isoformat() != timestamp:
+        return None
+    return (moment - EPOCH) // MICROSECOND
+
+def from_epoch(micros: int) -> str:
+    return (EPOCH + micros * MICROSECOND).isoformat()
+
+def json_default(value):
+    """json.dumps hook: compact records turn back into their JSON form, anything else into text"""
+    to_json = getattr(value, 'to_json', None)
+    return to_json() if to_json else str(value)
+
+class CodeTable:
+    """Small numbers for a small set of repeated strings, such as moods and relationship levels"""
+    
+    LIMIT = 65536  # codes are stored as unsigned shorts
+    
+    def __init__(self, values):
+        self.values = []
+        self.codes = {}
+        for value in values:
+            self.code(value)
+            
+    def code(self, value) -> Optional[int]:
+        """The value's code, adding it if it's new; None for values that can't have one"""
+        if value is not None and type(value) is not str:
+            return None
+        code = self.codes.get(value)
+        if code is None and len(self.values) < self.LIMIT:
+            code = self.codes[value] = len(self.values)
+            self.values.append(sys.intern(value) if value is not None else None)
+        return code
+
+MOOD_CODES = CodeTable([None] + MOODS)
+LEVEL_CODES = CodeTable([None] + RELATIONSHIP_LEVELS)
+
+class InteractionHistory:
+    """A user's recent interactions in a fixed-size ring buffer, one array per field.
+    
+    Iterating or slicing gives the interactions back as the dicts they were
+    added as, oldest first. An entry that doesn't fit the arrays (an odd
+    timestamp, extra keys) is kept whole, so the JSON form is lossless.
+    """
+    
+    __slots__ = ('capacity', 'start', 'columns', 'odd')
+    
+    FIELDS = ('timestamp', 'user_message_length', 'bot_response_length', 'mood_used', 'relationship_level')
+    FIELD_SET = set(FIELDS)
+    TYPECODES = 'qIIHH'
+    MAX_LENGTH = 2 ** 32 - 1
+    
+    def __init__(self, capacity: int, entries=()):
+        self.capacity = max(capacity, 1)
+        self.start = 0  # position of the oldest entry, once the buffer is full
+        self.columns = None  # one array per field, made on first use
+        self.odd = None  # position -> entry kept as it came
+        for entry in entries:
+            self.append(entry)
+            
+    def __len__(self) -> int:
+        return len(self.columns[0]) if self.columns else 0
+        
+    def pack(self, entry) -> Optional[tuple]:
+        """The entry as one number per field, or None if it doesn't fit the arrays"""
+        if type(entry) is not dict or entry.keys() != self.FIELD_SET:
+            return None
+        timestamp = to_epoch(entry['timestamp'])
+        user_length = entry['user_message_length']
+        bot_length = entry['bot_response_length']
+        mood = MOOD_CODES.code(entry['mood_used'])
+        level = LEVEL_CODES.code(entry['relationship_level'])
+        if timestamp is None or mood is None or level is None:
+            return None
+        for length in (user_length, bot_length):
+            if type(length) is not int or not 0 <= length <= self.MAX_LENGTH:
+                return None
+        return timestamp, user_length, bot_length, mood, level
+        
+    def entry(self, position: int) -> dict:
+        if self.odd and position in self.odd:
+            return self.odd[position]
+        timestamp, user_length, bot_length, mood, level = (column[position] for column in self.columns)
+        return {
+            'timestamp': from_epoch(timestamp),
+            'user_message_length': user_length,
+            'bot_response_length': bot_length,
+            'mood_used': MOOD_CODES.values[mood],
+            'relationship_level': LEVEL_CODES.values[level]
+        }
+        
+    def append(self, entry: dict) -> Optional[dict]:
+        """Add the newest interaction; once full, the oldest makes room and is returned"""
+        if self.columns is None:
+            self.columns = tuple(array(typecode) for typecode in self.TYPECODES)
+        packed = self.pack(entry)
+        values = packed or (0,) * len(self.FIELDS)
+        
+        if len(self) < self.capacity:
+            position, evicted = len(self), None
+            for column, value in zip(self.columns, values):
+                column.append(value)
+        else:
+            position, evicted = self.start, self.entry(self.start)
+            for column, value in zip(self.columns, values):
+                column[position] = value
+            self.start = (position + 1) % self.capacity
+            if self.odd:
+                self.odd.pop(position, None)
+                
+        if packed is None:
+            if self.odd is None:
+                self.odd = {}
+            self.odd[position] = entry
+        return evicted
+        
+    def __iter__(self):
+        count = len(self)
+        for offset in range(count):
+            yield self.entry((self.start + offset) % count)
+            
+    def __getitem__(self, index):
+        return list(self)[index]
+        
+    def to_json(self) -> list:
+        return list(self)
+
+class Record:
+    """Base of the compact records the memory layer keeps instead of JSON dicts.
+    
+    Every field of the schema has a slot holding it packed: timestamps as
+    epoch microseconds, repeated names as interned strings, interaction
+    history as an InteractionHistory. Values that can't be packed without
+    loss, and fields the schema doesn't know, stay as they are in `extra`.
+    Records read and write like the dicts they came from, so the rest of
+    the bot doesn't need to know which one it has.
+    """
+    
+    __slots__ = ('extra',)
+    
+    FIELDS = {}  # JSON field -> how it's packed: 'time', 'name', 'names', 'history' or 'value'
+    
     def __init__(self):
-        self.data_dir = 'mindcord_data'
-        self.ensure_data_dir()
+        self.extra = None
         
-    def ensure_data_dir(self):
-        """Create data directory if it doesn't exist"""
-        if not os.path.exists(self.data_dir):
-            os.makedirs(self.data_dir)
+    @classmethod
+    def from_json(cls, data: dict):
+        record = cls()
+        for key, value in data.items():
+            record[key] = value
+        return record
+        
+    def to_json(self) -> dict:
+        data = {}
+        for key in self.FIELDS:
+            value = self.get(key, MISSING)
+            if value is not MISSING:
+                data[key] = value.to_json() if isinstance(value, InteractionHistory) else value
+        if self.extra:
+            data.update(self.extra)
+        return data
+        
+    @staticmethod
+    def pack(kind: str, value):
+        """A field's value packed, or MISSING if it has to stay as it is"""
+        if kind == 'time':
+            if value is None:
+                return None
+            micros = to_epoch(value)
+            return MISSING if micros is None else micros
+        if kind == 'name':
+            return sys.intern(value) if type(value) is str else value
+        if kind == 'names':
+            if type(value) is list:
+                return [sys.intern(item) if type(item) is str else item for item in value]
+            return value
+        if kind == 'history':
+            if isinstance(value, InteractionHistory):
+                return value
+            if type(value) is list:
+                return InteractionHistory(max(RETENTION_MAX_INTERACTIONS, len(value)), value)
+            return MISSING
+        return value
+        
+    def get(self, key: str, default=None):
+        kind = self.FIELDS.get(key)
+        if kind is not None:
+            value = getattr(self, key, MISSING)
+            if value is not MISSING:
+                return from_epoch(value) if kind == 'time' and value is not None else value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+        
+    def __getitem__(self, key: str):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+        
+    def __setitem__(self, key: str, value):
+        kind = self.FIELDS.get(key)
+        packed = MISSING if kind is None else self.pack(kind, value)
+        if packed is MISSING:
+            if kind is not None and hasattr(self, key):
+                delattr(self, key)
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        else:
+            setattr(self, key, packed)
+            if self.extra:
+                self.extra.pop(key, None)
+                
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, MISSING) is not MISSING
+        
+    def setdefault(self, key: str, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+class UserRecord(Record):
+    FIELDS = {
+        'name': 'value',
+        'first_seen': 'time',
+        'relationship_level': 'name',
+        'conversation_topics': 'value',
+        'personality_notes': 'value',
+        'interests': 'value',
+        'communication_style': 'name',
+        'successful_interactions': 'history',
+        'my_personality_with_them': 'value',
+        'servers_shared': 'names',
+        'last_seen': 'time',
+        'total_interactions': 'value',
+        'custom_memories': 'value',
+        'interaction_summary': 'value'
+    }
+    __slots__ = tuple(FIELDS)
+
+class ServerRecord(Record):
+    FIELDS = {
+        'name': 'value',
+        'culture': 'name',
+        'activity_level': 'name',
+        'common_topics': 'value',
+        'inside_jokes': 'value',
+        'my_role_here': 'name',
+        'successful_personalities': 'value',
+        'last_active': 'time',
+        'member_count': 'value'
+    }
+    __slots__ = tuple(FIELDS)
+
+class PersonalityRecord(Record):
+    FIELDS = {
+        'main_mood': 'name',
+        'secondary_mood': 'name',
+        'energy_level': 'name',
+        'custom_states': 'value',
+        'interests': 'value',
+        'daily_thoughts': 'value',
+        'mood_history': 'value',
+        'successful_personalities': 'value',
+        'creator_relationship': 'name',
+        'last_mood_change': 'time'
+    }
+    __slots__ = tuple(FIELDS)
+
+# Collection, or (collection, key) for state documents -> record type kept in memory
+RECORD_TYPES = {'users': UserRecord, 'servers': ServerRecord, ('state', 'personality'): PersonalityRecord}
+
+class StorageBackend:
+    """Where MindcordMemory keeps its records.
+    
+    Records live in collections: 'users' and 'servers' keyed by Discord ID,
+    and 'state' for single documents such as the personality.
+    """
+    
+    def load_record(self, collection: str, key: str) -> Optional[dict]:
+        """Load one record, or None if it doesn't exist"""
+        raise NotImplementedError
+        
+    def save_records(self, collection: str, records: Dict[str, dict]):
+        """Insert or replace the given records"""
+        raise NotImplementedError
+        
+    def find_keys(self, collection: str, field: str, values: List[str]) -> List[str]:
+        """Keys of records whose field has one of the given values"""
+        raise NotImplementedError
+        
+    def scan_keys(self, collection: str, after: Optional[str], limit: int) -> List[str]:
+        """Up to limit keys in sorted order, starting after the given key (None for the start)"""
+        raise NotImplementedError
+        
+    def scan_fields(self, collection: str, fields: List[str]):
+        """Yield (key, [value of each field]) for every record"""
+        raise NotImplementedError
+        
+    def delete_records(self, collection: str, keys: List[str]):
+        """Remove the given records"""
+        raise NotImplementedError
+        
+    # Whether several processes can use the same store at once
+    shareable = False
+    
+    def claim_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Take or renew a named lease for ttl seconds; True if holder has it"""
+        return True
+        
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Keep other processes from writing during a read-modify-write; the body must not await"""
+        yield
+        
+    def needs_compaction(self) -> bool:
+        """Whether compact() has work to do"""
+        return False
+        
+    async def compact(self):
+        """Background housekeeping, for backends that need it"""
+        pass
+        
+    def close(self):
+        """Release any open files or connections"""
+        pass
+        
+    # MindcordMemory points this at its writer thread; None writes straight away
+    writer = None
+    
+    def write(self, collection: str, changes: dict):
+        """Pass {key: serialized record, or None to delete} to write_changes, on the writer thread if there is one"""
+        if self.writer:
+            self.writer.submit((self, collection), functools.partial(self.write_changes, collection), changes)
+        else:
+            self.write_changes(collection, changes)
             
+    def write_changes(self, collection: str, changes: dict):
+        """Persist what write() was given; may run on the writer thread, so touches nothing else the bot changes"""
+        raise NotImplementedError
+        
+    def pending_change(self, collection: str, key: str):
+        """(True, change) while a change to key is waiting for the writer thread, else (False, None)"""
+        if self.writer is None:
+            return False, None
+        return self.writer.pending_change((self, collection), key)
+
+class SortedKeys:
+    """A collection's keys in sorted order, kept up to date as records come and go.
+    
+    For scan_keys() on backends without an ordered index: sorted once on
+    first use, then each new or deleted key is a bisect instead of a sort.
+    """
+    
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        
+    def add(self, key: str):
+        index = bisect.bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            self.keys.insert(index, key)
+            
+    def discard(self, key: str):
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            del self.keys[index]
+            
+    def after(self, after: Optional[str], limit: int) -> List[str]:
+        """Up to limit keys following after (None for the start)"""
+        start = bisect.bisect_right(self.keys, after) if after is not None else 0
+        return self.keys[start:start + limit]
+
+class StorageWriter:
+    """One background thread doing every storage write, so serializing and
+    waiting on the disk happen off the event loop.
+    
+    Changes are submitted per target as {key: change}. Changes still waiting
+    for the same target are merged, so a record saved several times before
+    the thread gets to it is written once. submit() never blocks, since it
+    runs on the event loop; once max_pending changes are waiting, callers
+    hold back with wait_for_room() in a worker thread (MindcordMemory's
+    wait_for_writer()) until the thread catches up. A failed write is
+    put back and retried, but only close_retries times once closing, after
+    which its changes are dropped and reported.
+    """
+    
+    RETRY_DELAY = 1.0
+    
+    def __init__(self, max_pending: int, close_retries: int = STORAGE_WRITER_CLOSE_RETRIES):
+        self.max_pending = max_pending
+        self.close_retries = close_retries
+        self.failures = Counter()  # target -> failed writes in a row
+        self.pending = {}  # target -> (write function, {key: change}), oldest first
+        self.writing = {}  # target -> changes the thread is writing right now
+        self.pending_count = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stats = Counter()
+        self.thread = threading.Thread(target=self.run, name='mindcord-storage-writer', daemon=True)
+        self.thread.start()
+        
+    def submit(self, target, write, changes: dict):
+        """Queue write(changes) for the thread, merged into whatever is still waiting for target"""
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Storage writer is closed')
+            entry = self.pending.get(target)
+            if entry is None:
+                entry = self.pending[target] = (write, {})
+            waiting = entry[1]
+            before = len(waiting)
+            waiting.update(changes)
+            added = len(waiting) - before
+            self.pending_count += added
+            self.stats['changes'] += len(changes)
+            self.stats['coalesced'] += len(changes) - added
+            self.condition.notify_all()
+            
+    def pending_change(self, target, key: str):
+        """(True, change) if a change to key is waiting or being written, else (False, None)"""
+        with self.condition:
+            entry = self.pending.get(target)
+            for changes in (entry[1] if entry else {}, self.writing.get(target, {})):
+                if key in changes:
+                    return True, changes[key]
+        return False, None
+        
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                target = next(iter(self.pending))
+                write, changes = self.pending.pop(target)
+                self.writing = {target: changes}
+                
+            started = time.perf_counter()
+            try:
+                write(changes)
+                failed = False
+            except Exception as e:
+                print(f'💾 Storage write failed, retrying: {e}')
+                failed = True
+            metrics.observe('storage_write_seconds', time.perf_counter() - started)
+            
+            with self.condition:
+                self.writing = {}
+                if failed:
+                    self.failures[target] += 1
+                if failed and self.closed and self.failures[target] > self.close_retries:
+                    # Shutting down and the write keeps failing: don't hold the process up forever
+                    keys = sorted(map(str, changes))
+                    more = ' ...' if len(keys) > 10 else ''
+                    print(f'💾 Gave up after {self.failures[target]} failed writes, {len(changes)} changes not written '
+                          f'({target[-1] if isinstance(target, tuple) else target}: {", ".join(keys[:10])}{more})')
+                    self.stats['dropped'] += len(changes)
+                    self.pending_count -= len(changes)
+                    del self.failures[target]
+                    failed = False
+                elif failed:
+                    # Put the changes back under anything newer for the same records
+                    self.stats['errors'] += 1
+                    entry = self.pending.get(target)
+                    newer = entry[1] if entry else {}
+                    merged = {**changes, **newer}
+                    self.pending[target] = (write, merged)
+                    self.pending_count += len(merged) - len(changes) - len(newer)
+                else:
+                    self.stats['writes'] += 1
+                    self.pending_count -= len(changes)
+                    self.failures.pop(target, None)
+                self.condition.notify_all()
+            if failed:
+                time.sleep(self.RETRY_DELAY)
+                
+    def has_room(self) -> bool:
+        return self.pending_count < self.max_pending
+        
+    def wait_for_room(self):
+        """Block until fewer than max_pending changes are waiting; call it off the event loop"""
+        with self.condition:
+            if self.has_room():
+                return
+            # The disk is falling behind: wait instead of piling up more
+            self.stats['blocked'] += 1
+            started = time.perf_counter()
+            self.condition.wait_for(self.has_room)
+        metrics.observe('storage_writer_blocked_seconds', time.perf_counter() - started)
+            
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything submitted so far is written; False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.writing, timeout)
+            
+    def close(self, timeout: Optional[float] = None):
+        """Write what's left and stop the thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f'💾 Gave up waiting for storage writes, {self.pending_count} changes not written')
+            
+    async def aflush(self):
+        await asyncio.to_thread(self.flush)
+        
+    async def aclose(self, timeout: Optional[float] = None):
+        await asyncio.to_thread(self.close, timeout)
+
+class JsonBackend(StorageBackend):
+    """Original layout: one indented JSON file per collection.
+    
+    Reads come from the records as the bot last saved them. Writing keeps a
+    second copy of each file's records, built only from what write() was
+    given, so the writer thread never reads records the bot is changing.
+    """
+    
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.files = {}
+        self.written = {}  # collection -> records as last written
+        self.key_order = {}  # collection -> SortedKeys, once something scans it
+        
     def load_json(self, filename: str) -> dict:
         """Load JSON file or return empty dict"""
         filepath = os.path.join(self.data_dir, filename)
         try:
             with open(filepath, 'r') as f:
-                return json.load(f)
+                data = json.load(f)
+                metrics.count('storage_bytes_read_total', f.tell(), backend='json')
+                return data
         except FileNotFoundError:
             return {}
             
     def save_json(self, filename: str, data: dict):
         """Save data to JSON file"""
         filepath = os.path.join(self.data_dir, filename)
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2, default=str)
+        
+        # Write a temporary file and rename it over the old one, so a crash
+        # mid-write can't leave a half-written file behind
+        tmp_path = f'{filepath}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, default=json_default)
+            metrics.count('storage_bytes_written_total', f.tell(), backend='json')
+        os.replace(tmp_path, filepath)
+            
+    def load_file(self, collection: str) -> dict:
+        """Get all records of a collection, reading its file on first use"""
+        records = self.files.get(collection)
+        if records is None:
+            records = self.load_json(f'{collection}.json')
+            self.files[collection] = records
+        return records
+        
+    def load_record(self, collection: str, key: str) -> Optional[dict]:
+        if collection == 'state':
+            found, record = self.pending_change(collection, key)
+            if found:
+                return json.loads(record) if record is not None else None
+            return self.load_json(f'{key}.json') or None
+        return self.load_file(collection).get(key)
+        
+    def save_records(self, collection: str, records: Dict[str, dict]):
+        if collection != 'state':
+            self.load_file(collection).update(records)
+            order = self.key_order.get(collection)
+            if order is not None:
+                for key in records:
+                    order.add(key)
+        self.write(collection, {
+            key: json.dumps(data, separators=(',', ':'), default=json_default) for key, data in records.items()
+        })
+        
+    def write_changes(self, collection: str, changes: dict):
+        if collection == 'state':
+            for key, record in changes.items():
+                if record is None:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(self.data_dir, f'{key}.json'))
+                else:
+                    self.save_json(f'{key}.json', json.loads(record))
+            return
+        
+        # The whole file has to be rewritten to change any record in it
+        records = self.written.get(collection)
+        if records is None:
+            records = self.written[collection] = self.load_json(f'{collection}.json')
+        for key, record in changes.items():
+            if record is None:
+                records.pop(key, None)
+            else:
+                records[key] = json.loads(record)
+        self.save_json(f'{collection}.json', records)
+        
+    def find_keys(self, collection: str, field: str, values: List[str]) -> List[str]:
+        return [
+            key for key, data in self.load_file(collection).items()
+            if data.get(field) in values
+        ]
+        
+    def scan_keys(self, collection: str, after: Optional[str], limit: int) -> List[str]:
+        order = self.key_order.get(collection)
+        if order is None:
+            order = self.key_order[collection] = SortedKeys(self.load_file(collection))
+        return order.after(after, limit)
+        
+    def scan_fields(self, collection: str, fields: List[str]):
+        records = self.load_file(collection)
+        for key in list(records):
+            data = records.get(key)
+            if data is not None:
+                yield key, [data.get(field) for field in fields]
+            
+    def delete_records(self, collection: str, keys: List[str]):
+        if collection != 'state':
+            all_records = self.load_file(collection)
+            order = self.key_order.get(collection)
+            for key in keys:
+                all_records.pop(key, None)
+                if order is not None:
+                    order.discard(key)
+        self.write(collection, dict.fromkeys(keys))
+
+class SqliteBackend(StorageBackend):
+    """One row per user/server in an SQLite database running in WAL mode"""
+    
+    # Fields copied into their own indexed columns for fast lookups
+    INDEXED_FIELDS = {'users': ['relationship_level']}
+    
+    shareable = True
+    
+    def __init__(self, path: str, data_dir: str):
+        self.conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # Records are written through their own connection, which the writer thread may use
+        self.write_conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        self.write_conn.execute('PRAGMA synchronous=NORMAL')
+        self.in_transaction = False  # inside transaction(), which commits the writes itself
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS users '
+                '(key TEXT PRIMARY KEY, relationship_level TEXT, data TEXT NOT NULL)'
+            )
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS users_relationship_level ON users (relationship_level)'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS servers (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT, expires REAL)')
+        self.migrate_from_json(data_dir)
+        
+    def load_record(self, collection: str, key: str) -> Optional[dict]:
+        found, change = self.pending_change(collection, key)
+        if found:
+            return json.loads(change[-1]) if change is not None else None
+        row = self.conn.execute(f'SELECT data FROM {collection} WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        metrics.count('storage_bytes_read_total', len(row[0]), backend='sqlite')
+        return json.loads(row[0])
+        
+    def save_records(self, collection: str, records: Dict[str, dict]):
+        fields = self.INDEXED_FIELDS.get(collection, [])
+        self.write(collection, {
+            key: (*[data.get(field) for field in fields], json.dumps(data, separators=(',', ':'), default=json_default))
+            for key, data in records.items()
+        })
+        
+    def write_changes(self, collection: str, changes: dict):
+        fields = self.INDEXED_FIELDS.get(collection, [])
+        columns = ', '.join(['key'] + fields + ['data'])
+        placeholders = ', '.join('?' * (len(fields) + 2))
+        rows = [(key, *row) for key, row in changes.items() if row is not None]
+        deleted = [(key,) for key, row in changes.items() if row is None]
+        with contextlib.nullcontext() if self.in_transaction else self.write_conn:
+            if rows:
+                self.write_conn.executemany(
+                    f'INSERT OR REPLACE INTO {collection} ({columns}) VALUES ({placeholders})', rows
+                )
+            if deleted:
+                self.write_conn.executemany(f'DELETE FROM {collection} WHERE key = ?', deleted)
+        metrics.count('storage_bytes_written_total', sum(len(row[-1]) for row in rows), backend='sqlite')
+            
+    def find_keys(self, collection: str, field: str, values: List[str]) -> List[str]:
+        placeholders = ', '.join('?' * len(values))
+        if field in self.INDEXED_FIELDS.get(collection, []):
+            column = field
+        else:
+            column = f"json_extract(data, '$.{field}')"
+        rows = self.conn.execute(
+            f'SELECT key FROM {collection} WHERE {column} IN ({placeholders})', list(values)
+        )
+        return [row[0] for row in rows]
+        
+    def scan_keys(self, collection: str, after: Optional[str], limit: int) -> List[str]:
+        rows = self.conn.execute(
+            f'SELECT key FROM {collection} WHERE key > ? ORDER BY key LIMIT ?', (after or '', limit)
+        )
+        return [row[0] for row in rows]
+        
+    def scan_fields(self, collection: str, fields: List[str]):
+        # json_array keeps list and object fields as JSON rather than text
+        columns = ', '.join(f"json_extract(data, '$.{field}')" for field in fields)
+        # Fetched up front, so callers can write on this connection between rows
+        rows = self.conn.execute(f'SELECT key, json_array({columns}) FROM {collection}').fetchall()
+        for key, values in rows:
+            yield key, json.loads(values)
+        
+    def delete_records(self, collection: str, keys: List[str]):
+        self.write(collection, dict.fromkeys(keys))
+            
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        # Take the database write lock before the read, so no other process can
+        # write the record between our read and our write. Waiting for it is
+        # done here between short tries, not inside sqlite3 on the event loop
+        deadline = time.monotonic() + SQLITE_LOCK_WAIT
+        delay = 0.005
+        while not self.begin_immediate():
+            if time.monotonic() >= deadline:
+                raise sqlite3.OperationalError('database is locked')
+            metrics.count('storage_lock_retries_total')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+            
+        self.in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self.write_conn.rollback()
+            raise
+        else:
+            self.write_conn.commit()
+        finally:
+            self.in_transaction = False
+            
+    def begin_immediate(self) -> bool:
+        """Start a write transaction if the write lock is free right now"""
+        self.write_conn.execute('PRAGMA busy_timeout = 0')
+        try:
+            self.write_conn.execute('BEGIN IMMEDIATE')
+            return True
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            return False
+        finally:
+            self.write_conn.execute(f'PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT * 1000)}')
+            
+    def claim_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires '
+                'WHERE leases.holder = excluded.holder OR leases.expires < ?',
+                (name, holder, now + ttl, now)
+            )
+        row = self.conn.execute('SELECT holder FROM leases WHERE name = ?', (name,)).fetchone()
+        return row[0] == holder
+        
+    def migrate_from_json(self, data_dir: str):
+        """One-shot import of the old mindcord_data/*.json files"""
+        if self.load_record('state', 'json_migration') is not None:
+            return
+        
+        source = JsonBackend(data_dir)
+        counts = {}
+        for collection in ('users', 'servers'):
+            records = source.load_file(collection)
+            if records:
+                self.save_records(collection, records)
+            counts[collection] = len(records)
+        
+        personality = source.load_record('state', 'personality')
+        if personality:
+            self.save_records('state', {'personality': personality})
+        
+        self.save_records('state', {'json_migration': {
+            'migrated_at': datetime.datetime.now().isoformat(),
+            'users': counts['users'],
+            'servers': counts['servers']
+        }})
+        if counts['users'] or counts['servers']:
+            print(f"💾 Migrated {counts['users']} users and {counts['servers']} servers from JSON to SQLite")
+        
+    def close(self):
+        self.conn.close()
+        self.write_conn.close()
+
+class SnapshotFile:
+    """Compact binary snapshot of every record, read through mmap.
+    
+    Layout (little-endian): a header with the magic, index offset and record
+    count; the records, each a u32 length and the record's compact JSON; then
+    the index, one (collection id u8, key length u16, record offset u64, key)
+    entry per record. Opening only walks the index, and a record is decoded
+    the first time something asks for it.
+    """
+    
+    MAGIC = b'MCSNAP01'
+    HEADER = struct.Struct('<8sQI')
+    LENGTH = struct.Struct('<I')
+    INDEX_ENTRY = struct.Struct('<BHQ')
+    COLLECTIONS = ('users', 'servers', 'state')
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.index_offset, self.count = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a Mindcord snapshot')
+            
+    def index(self):
+        """Yield (collection, key, record offset) for every record"""
+        pos = self.index_offset
+        for _ in range(self.count):
+            collection, key_length, offset = self.INDEX_ENTRY.unpack_from(self.map, pos)
+            pos += self.INDEX_ENTRY.size
+            key = self.map[pos:pos + key_length].decode()
+            pos += key_length
+            yield self.COLLECTIONS[collection], key, offset
+        metrics.count('storage_bytes_read_total', pos - self.index_offset, backend='journal')
+        
+    def read(self, offset: int) -> bytes:
+        """Raw JSON of the record at offset"""
+        (length,) = self.LENGTH.unpack_from(self.map, offset)
+        start = offset + self.LENGTH.size
+        return self.map[start:start + length]
+        
+    def decode(self, offset: int) -> dict:
+        data = self.read(offset)
+        metrics.count('storage_bytes_read_total', len(data), backend='journal')
+        return json.loads(data)
+        
+    def records(self):
+        """Yield (collection, key, record) for every record"""
+        for collection, key, offset in self.index():
+            yield collection, key, self.decode(offset)
+            
+    @classmethod
+    def write(cls, path: str, records) -> List[int]:
+        """Write (collection, key, JSON bytes) records to path, returning their offsets"""
+        collection_ids = {name: i for i, name in enumerate(cls.COLLECTIONS)}
+        offsets = []
+        index = []
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, 0, 0))
+            for collection, key, data in records:
+                offsets.append(f.tell())
+                f.write(cls.LENGTH.pack(len(data)))
+                f.write(data)
+                key = key.encode()
+                index.append(cls.INDEX_ENTRY.pack(collection_ids[collection], len(key), offsets[-1]) + key)
+            index_offset = f.tell()
+            f.write(b''.join(index))
+            f.seek(0)
+            f.write(cls.HEADER.pack(cls.MAGIC, index_offset, len(offsets)))
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0, os.SEEK_END)
+            metrics.count('storage_bytes_written_total', f.tell(), backend='journal')
+        return offsets
+        
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def read_journal(path: str):
+    """Yield (collection, key, record) entries of a journal file, skipping a torn last line.
+    
+    A record of None means the key was deleted. Any other line that doesn't
+    parse is reported and skipped.
+    """
+    try:
+        f = open(path, 'r')
+    except FileNotFoundError:
+        return
+    with f:
+        for number, line in enumerate(f, 1):
+            if not line.endswith('\n'):
+                # Torn last line from a crash mid-append
+                break
+            try:
+                entry = json.loads(line)
+                change = entry['c'], entry['k'], entry['v']
+            except (ValueError, KeyError, TypeError) as e:
+                print(f'💾 Skipping unreadable line {number} of {path}: {e}')
+                metrics.count('storage_journal_bad_lines_total')
+                continue
+            yield change
+        metrics.count('storage_bytes_read_total', f.tell(), backend='journal')
+
+class JournalBackend(StorageBackend):
+    """Binary snapshot plus an append-only journal of record changes.
+    
+    Every save appends one compact JSON line per record, so writing costs
+    as much as the change. compact() folds the journal into a new snapshot
+    in a worker thread and swaps it in with an atomic rename. Records are
+    held in memory either as an offset into the mmapped snapshot, decoded
+    only when asked for, or as the compact JSON from their last save, which
+    also means the compactor can write them out while the bot keeps
+    changing its own copies.
+    """
+    
+    SNAPSHOT_FILE = 'snapshot.bin'
+    JOURNAL_FILE = 'journal.jsonl'
+    ROTATED_FILE = 'journal.compacting.jsonl'
+    LEGACY_SNAPSHOT_FILE = 'snapshot.jsonl'
+    
+    def __init__(self, data_dir: str):
+        self.snapshot_path = os.path.join(data_dir, self.SNAPSHOT_FILE)
+        self.journal_path = os.path.join(data_dir, self.JOURNAL_FILE)
+        self.rotated_path = os.path.join(data_dir, self.ROTATED_FILE)
+        self.legacy_snapshot_path = os.path.join(data_dir, self.LEGACY_SNAPSHOT_FILE)
+        self.records = {'users': {}, 'servers': {}, 'state': {}}  # collection -> {key: snapshot offset or JSON}
+        self.snapshot = None
+        self.compacting = False
+        self.journal_lock = threading.Lock()  # the writer thread appends while compaction rotates
+        self.key_order = {}  # collection -> SortedKeys, once something scans it
+        
+        paths = (self.snapshot_path, self.legacy_snapshot_path, self.journal_path, self.rotated_path)
+        fresh = not any(os.path.exists(path) for path in paths)
+        if os.path.exists(self.snapshot_path):
+            self.snapshot = SnapshotFile(self.snapshot_path)
+            for collection, key, offset in self.snapshot.index():
+                self.records[collection][key] = offset
+                
+        # Appending after a torn last line would glue the next change onto it
+        self.trim_torn_tail(self.journal_path)
+        
+        # Snapshots used to be JSON lines in the journal's own format
+        replayed = 0
+        legacy = self.snapshot is None and os.path.exists(self.legacy_snapshot_path)
+        for path in (self.legacy_snapshot_path if legacy else None, self.rotated_path, self.journal_path):
+            if path:
+                replayed += self.load_journal(path)
+                
+        self.journal = open(self.journal_path, 'a')
+        self.journal_size = self.journal.tell()
+        
+        if fresh:
+            self.import_json(data_dir)
+        elif replayed > JOURNAL_MAX_REPLAY_BYTES or legacy or os.path.exists(self.rotated_path):
+            # Don't leave this much replay for the next start
+            print(f'💾 Replayed {replayed / 1024 / 1024:.1f} MiB of journal, compacting before serving')
+            self.compact_now()
+            
+    @staticmethod
+    def trim_torn_tail(path: str, chunk_size: int = 65536):
+        """Cut a journal file back to just after its last newline"""
+        try:
+            f = open(path, 'rb+')
+        except FileNotFoundError:
+            return
+        with f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - chunk_size)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                print(f'💾 Dropping {size - end} bytes of torn journal line from {path}')
+                f.truncate(end)
+                
+    def load_journal(self, path: str) -> int:
+        """Apply a journal file, returning how many bytes it had"""
+        if not os.path.exists(path):
+            return 0
+        for collection, key, data in read_journal(path):
+            if data is None:
+                self.records[collection].pop(key, None)
+            else:
+                self.records[collection][key] = json.dumps(data, separators=(',', ':'), default=json_default)
+        return os.path.getsize(path)
+        
+    def import_json(self, data_dir: str):
+        """First start: bring in the old mindcord_data/*.json files"""
+        source = JsonBackend(data_dir)
+        for collection in ('users', 'servers'):
+            records = source.load_file(collection)
+            if records:
+                self.save_records(collection, records)
+        personality = source.load_record('state', 'personality')
+        if personality:
+            self.save_records('state', {'personality': personality})
+        if self.journal_size:
+            self.compact_now()
+            
+    def load_record(self, collection: str, key: str) -> Optional[dict]:
+        record = self.records[collection].get(key)
+        if record is None:
+            return None
+        if isinstance(record, int):
+            return self.snapshot.decode(record)
+        return json.loads(record)
+        
+    def save_records(self, collection: str, records: Dict[str, dict]):
+        stored = self.records[collection]
+        changes = {}
+        for key, data in records.items():
+            record = json.dumps(data, separators=(',', ':'), default=json_default)
+            stored[key] = record
+            changes[key] = record
+        order = self.key_order.get(collection)
+        if order is not None:
+            for key in changes:
+                order.add(key)
+        self.write(collection, changes)
+        
+    def delete_records(self, collection: str, keys: List[str]):
+        stored = self.records[collection]
+        order = self.key_order.get(collection)
+        for key in keys:
+            stored.pop(key, None)
+            if order is not None:
+                order.discard(key)
+        self.write(collection, dict.fromkeys(keys))
+        
+    def write_changes(self, collection: str, changes: dict):
+        # A null record in the journal marks a deletion
+        self.append(''.join(
+            f'{{"c":"{collection}","k":{json.dumps(key)},"v":{"null" if record is None else record}}}\n'
+            for key, record in changes.items()
+        ))
+        
+    def append(self, text: str):
+        """Append lines to the journal"""
+        with self.journal_lock:
+            self.journal.write(text)
+            self.journal.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(self.journal.fileno())
+            self.journal_size += len(text)
+        metrics.count('storage_bytes_written_total', len(text), backend='journal')
+        
+    def find_keys(self, collection: str, field: str, values: List[str]) -> List[str]:
+        # Cheap substring test on the serialized record before paying for a parse
+        needles = [json.dumps({field: value}, separators=(',', ':'))[1:-1] for value in values]
+        raw_needles = [needle.encode() for needle in needles]
+        keys = []
+        for key, record in self.records[collection].items():
+            if isinstance(record, int):
+                data = self.snapshot.read(record)
+                if any(needle in data for needle in raw_needles) and json.loads(data).get(field) in values:
+                    keys.append(key)
+            elif any(needle in record for needle in needles) and json.loads(record).get(field) in values:
+                keys.append(key)
+        return keys
+        
+    def scan_keys(self, collection: str, after: Optional[str], limit: int) -> List[str]:
+        order = self.key_order.get(collection)
+        if order is None:
+            order = self.key_order[collection] = SortedKeys(self.records[collection])
+        return order.after(after, limit)
+        
+    def scan_fields(self, collection: str, fields: List[str]):
+        for key in list(self.records[collection]):
+            data = self.load_record(collection, key)
+            if data is not None:
+                yield key, [data.get(field) for field in fields]
+                
+    def rotate(self) -> list:
+        """Start a new journal and return every current (collection, key, record) for the snapshot"""
+        with self.journal_lock:
+            self.journal.close()
+            os.replace(self.journal_path, self.rotated_path)
+            self.journal = open(self.journal_path, 'a')
+            self.journal_size = 0
+        return [
+            (collection, key, record)
+            for collection, records in self.records.items()
+            for key, record in records.items()
+        ]
+        
+    def write_snapshot(self, records: list) -> List[int]:
+        """Write a new snapshot atomically, then drop the journal it replaces"""
+        old = self.snapshot
+        encoded = (
+            (collection, key, old.read(record) if isinstance(record, int) else record.encode())
+            for collection, key, record in records
+        )
+        tmp_path = f'{self.snapshot_path}.tmp'
+        offsets = SnapshotFile.write(tmp_path, encoded)
+        os.replace(tmp_path, self.snapshot_path)
+        for path in (self.rotated_path, self.legacy_snapshot_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return offsets
+        
+    def install_snapshot(self, records: list, offsets: List[int]):
+        """Point records that haven't changed since rotate() at the new snapshot"""
+        new = SnapshotFile(self.snapshot_path)
+        for (collection, key, record), offset in zip(records, offsets):
+            stored = self.records[collection]
+            if stored.get(key) == record:
+                stored[key] = offset
+        old, self.snapshot = self.snapshot, new
+        if old:
+            old.close()
+            
+    def compact_now(self):
+        records = self.rotate()
+        self.install_snapshot(records, self.write_snapshot(records))
+        
+    def needs_compaction(self) -> bool:
+        return not self.compacting and self.journal_size >= JOURNAL_COMPACT_BYTES
+        
+    async def compact(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        try:
+            records = self.rotate()
+            offsets = await asyncio.to_thread(self.write_snapshot, records)
+            self.install_snapshot(records, offsets)
+        finally:
+            self.compacting = False
+            
+    def close(self):
+        self.journal.close()
+        if self.snapshot:
+            self.snapshot.close()
+
+def create_backend(data_dir: str, kind: Optional[str] = None) -> StorageBackend:
+    """Build a storage backend, by default the one picked by MINDCORD_STORAGE"""
+    kind = kind or STORAGE_BACKEND
+    if kind == 'json':
+        return JsonBackend(data_dir)
+    if kind == 'sqlite':
+        return SqliteBackend(os.path.join(data_dir, 'mindcord.db'), data_dir)
+    if kind == 'journal':
+        return JournalBackend(data_dir)
+    raise ValueError(f'Unknown storage backend: {kind}')
+
+# How likely a message is worth a look, by who sent it and where
+RELATIONSHIP_REPLY_WEIGHTS = {
+    'creator': 1.0,
+    'close_friend': 0.6,
+    'friend': 0.4,
+    'acquaintance': 0.2,
+    'new': 0.1
+}
+
+CHANNEL_REPLY_WEIGHTS = {
+    'general': 1.0,
+    'gaming': 1.0,
+    'memes': 0.8,
+    'serious': 0.3,
+    'tech': 1.0,
+    'music': 0.6,
+    'art': 0.6
+}
+
+class ResponseGate:
+    """Cheap local checks that reject most messages before the LLM decision"""
+    
+    NOISE_PATTERN = re.compile(r'https?://\S+|<a?:\w+:\d+>|<[@#][!&]?\d+>')
+    WORD_CHAR_PATTERN = re.compile(r'\w')
+    
+    def __init__(self):
+        self.last_reply = {}      # channel id -> monotonic time of our last reply
+        self.recent_replies = {}  # channel id -> reply times inside the budget window
+        self.stats = Counter()
+        
+    def channel_weight(self, channel) -> float:
+        """Weight for the channel type from CHANNEL_CONTEXTS"""
+        name = getattr(channel, 'name', '') or ''
+        for context, weight in CHANNEL_REPLY_WEIGHTS.items():
+            if context in name:
+                return weight
+        return 0.7
+        
+    def reject_reason(self, message, user_data: dict) -> Optional[str]:
+        """Why a message can be skipped without asking the LLM, or None if it's borderline"""
+        content = message.content.strip()
+        if content.startswith(bot.command_prefix):
+            return 'command'
+        
+        text = self.NOISE_PATTERN.sub('', content)
+        if len(self.WORD_CHAR_PATTERN.findall(text)) < GATE_MIN_CHARS:
+            return 'low_content'
+        
+        channel_id = message.channel.id
+        now = time.monotonic()
+        if now - self.last_reply.get(channel_id, float('-inf')) < GATE_COOLDOWN:
+            return 'cooldown'
+        
+        replies = self.recent_replies.get(channel_id)
+        if replies:
+            while replies and now - replies[0] > GATE_BUDGET_WINDOW:
+                replies.popleft()
+            if len(replies) >= GATE_CHANNEL_BUDGET:
+                return 'budget'
+        
+        chance = RELATIONSHIP_REPLY_WEIGHTS.get(user_data.get('relationship_level'), 0.1)
+        chance *= self.channel_weight(message.channel) * GATE_SAMPLE_RATE
+        if '?' in content:
+            chance *= 2
+        if random.random() >= chance:
+            return 'sampled_out'
+        
+        return None
+        
+    def allows(self, message, user_data: dict) -> bool:
+        """Check a message and count the outcome"""
+        reason = self.reject_reason(message, user_data)
+        if reason:
+            self.stats[reason] += 1
+            return False
+        self.stats['passed'] += 1
+        return True
+        
+    def record_reply(self, channel_id: int):
+        """Note that we just replied in a channel"""
+        now = time.monotonic()
+        self.last_reply[channel_id] = now
+        self.recent_replies.setdefault(channel_id, deque()).append(now)
+        
+    def llm_calls_saved(self) -> int:
+        """Decision calls skipped so far"""
+        return sum(count for reason, count in self.stats.items() if reason != 'passed')
+
+class ConversationBuffer:
+    """Ring buffer of recent messages per channel, evicting idle channels past a memory cap"""
+    
+    # Rough per-message cost of the tuple and strings on top of their text
+    ENTRY_OVERHEAD = 160
+    
+    def __init__(self, turns: int, max_chars: int, max_bytes: int):
+        self.turns = turns
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+        self.channels = OrderedDict()  # channel id -> deque of (message id, author, content), least recently active first
+        self.size = 0
+        self.evicted_channels = 0
+        
+    def entry_size(self, entry: tuple) -> int:
+        return self.ENTRY_OVERHEAD + len(entry[1]) + len(entry[2])
+        
+    def add(self, message):
+        """Record a message in its channel's buffer"""
+        author = 'you' if message.author == bot.user else message.author.display_name
+        entry = (message.id, author, message.content[:self.max_chars])
+        
+        channel_id = message.channel.id
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            buffer = self.channels[channel_id] = deque(maxlen=self.turns)
+        else:
+            self.channels.move_to_end(channel_id)
+        
+        if len(buffer) == buffer.maxlen:
+            self.size -= self.entry_size(buffer[0])
+        buffer.append(entry)
+        self.size += self.entry_size(entry)
+        
+        # Over the cap: forget the channels that have been quiet the longest
+        while self.size > self.max_bytes and len(self.channels) > 1:
+            _, idle = self.channels.popitem(last=False)
+            self.size -= sum(self.entry_size(old) for old in idle)
+            self.evicted_channels += 1
+            
+    def edit(self, channel_id: int, message_id: int, content: str):
+        """Replace a buffered message's text after it was edited, e.g. a streamed reply that finished"""
+        buffer = self.channels.get(channel_id)
+        if not buffer:
+            return
+        for index, entry in enumerate(buffer):
+            if entry[0] == message_id:
+                edited = (message_id, entry[1], content[:self.max_chars])
+                buffer[index] = edited
+                self.size += self.entry_size(edited) - self.entry_size(entry)
+                return
+                
+    def recent(self, channel_id: int, before_id: Optional[int] = None, limit: int = CONTEXT_PROMPT_TURNS) -> List[tuple]:
+        """Last `limit` (author, content) turns in a channel, optionally only those before a message"""
+        buffer = self.channels.get(channel_id)
+        if not buffer:
+            return []
+        
+        entries = list(buffer)
+        if before_id is not None:
+            for index, entry in enumerate(entries):
+                if entry[0] == before_id:
+                    entries = entries[:index]
+                    break
+        return [(author, content) for _, author, content in entries[-limit:]]
+        
+    def recent_lines(self, channel_id: int, before_id: Optional[int] = None) -> List[str]:
+        """Recent turns as prompt lines, oldest first"""
+        return [f'{author}: "{content}"' for author, content in self.recent(channel_id, before_id)]
+        
+    def stats(self) -> dict:
+        return {
+            'channels': len(self.channels),
+            'messages': sum(len(buffer) for buffer in self.channels.values()),
+            'bytes': self.size,
+            'evicted_channels': self.evicted_channels
+        }
+
+# Words too common to say anything about which memory is relevant
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'i', 'if', 'im', 'in', 'is', 'it',
+    'its', 'me', 'my', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'was', 'we', 'with', 'you'
+}
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words worth matching on"""
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS and len(word) > 1]
+
+class MemoryIndex:
+    """BM25 over one user's remembered texts, dropping the oldest past a cap"""
+    
+    K1 = 1.2
+    B = 0.75
+    MAX_TERMS = 64  # words indexed per memory and looked up per query
+    
+    def __init__(self, max_docs: int):
+        self.max_docs = max_docs
+        self.docs = {}  # doc id -> (text, length, term counts), oldest first
+        self.postings = {}  # term -> {doc id: count}
+        self.total_length = 0
+        self.next_id = 0
+        self.source_length = 0  # length of the memory list this index was kept in step with
+        
+    def add(self, text: str):
+        if len(self.docs) >= self.max_docs:
+            self.remove(next(iter(self.docs)))
+            
+        terms = Counter(tokenize(text)[:self.MAX_TERMS])
+        length = sum(terms.values())
+        doc_id = self.next_id
+        self.next_id += 1
+        self.docs[doc_id] = (text, length, terms)
+        self.total_length += length
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+            
+    def remove(self, doc_id: int):
+        _, length, terms = self.docs.pop(doc_id)
+        self.total_length -= length
+        for term in terms:
+            postings = self.postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+                
+    def search(self, query: str, k: int) -> List[str]:
+        """The k best-matching texts, best first; nothing if no word matches"""
+        if not self.docs:
+            return []
+        count = len(self.docs)
+        average_length = self.total_length / count or 1
+        scores = Counter()
+        for term in set(tokenize(query)[:self.MAX_TERMS]):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                length = self.docs[doc_id][1]
+                norm = frequency + self.K1 * (1 - self.B + self.B * length / average_length)
+                scores[doc_id] += idf * frequency * (self.K1 + 1) / norm
+        # Ties go to the more recent memory
+        best = heapq.nlargest(k, scores.items(), key=lambda item: (item[1], item[0]))
+        return [self.docs[doc_id][0] for doc_id, _ in best]
+
+class MemoryRetriever:
+    """Per-user memory indexes, built on first use and kept for the most recently active users"""
+    
+    def __init__(self, max_users: int, max_memories: int):
+        self.max_users = max_users
+        self.max_memories = max_memories
+        self.indexes = OrderedDict()  # user id -> MemoryIndex, least recently used first
+        self.builds = 0
+        
+    def index_for(self, user_id: str, memories: List[dict]) -> MemoryIndex:
+        # A count that doesn't match means the list changed elsewhere, e.g. in another worker
+        index = self.indexes.get(user_id)
+        if index is not None and index.source_length == len(memories):
+            self.indexes.move_to_end(user_id)
+            return index
+            
+        index = MemoryIndex(self.max_memories)
+        for entry in memories[-self.max_memories:]:
+            index.add(entry.get('info', ''))
+        index.source_length = len(memories)
+        self.indexes[user_id] = index
+        self.builds += 1
+        if len(self.indexes) > self.max_users:
+            self.indexes.popitem(last=False)
+        return index
+        
+    def add(self, user_id: str, info: str):
+        """Index a newly remembered text, if the user's index is loaded"""
+        index = self.indexes.get(user_id)
+        if index is not None:
+            index.add(info)
+            index.source_length += 1
+            
+    def forget(self, user_id: str):
+        """Drop a user's index after their memories changed other than by add()"""
+        self.indexes.pop(user_id, None)
+        
+    def relevant(self, user_id: str, memories: List[dict], query: str,
+                 k: int = RETRIEVAL_TOP_K, budget: int = RETRIEVAL_PROMPT_CHARS) -> List[str]:
+        """The remembered texts that best match the query, best first, within a character budget"""
+        if not memories:
+            return []
+        with metrics.timer('memory_retrieval'):
+            found = []
+            for text in self.index_for(user_id, memories).search(query, k):
+                if budget <= 0:
+                    break
+                text = text[:budget]
+                found.append(text)
+                budget -= len(text)
+        return found
+        
+    def stats(self) -> dict:
+        return {
+            'users': len(self.indexes),
+            'memories': sum(len(index.docs) for index in self.indexes.values()),
+            'builds': self.builds
+        }
+
+def compact(value, limit: int = 200) -> str:
+    """Short plain-text rendering of a context value for a prompt, instead of its Python repr"""
+    if isinstance(value, dict):
+        text = ', '.join(f'{key}: {compact(item, limit)}' for key, item in value.items() if item not in (None, '', [], {}))
+    elif isinstance(value, (list, tuple)):
+        text = ', '.join(compact(item, limit) for item in value if item not in (None, '', [], {}))
+    else:
+        text = str(value)
+    if not text:
+        return 'none'
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+class Section:
+    """Part of a prompt: a title and its lines, trimmed by priority when over budget.
+    
+    Priority 0 is never dropped, only shortened as a last resort; otherwise
+    the highest number goes first. keep_last sections (conversation history)
+    lose their oldest lines first, the rest lose lines from the end.
+    """
+    
+    __slots__ = ('priority', 'title', 'lines', 'keep_last')
+    
+    def __init__(self, priority: int, title: str, lines: List[str], keep_last: bool = False):
+        self.priority = priority
+        self.title = title
+        self.lines = list(lines)
+        self.keep_last = keep_last
+        
+    def size(self) -> int:
+        return len(self.title) + sum(len(line) + 1 for line in self.lines) + 2
+
+class PromptBuilder:
+    """Builds one kind of prompt: a fixed preamble and instructions around per-call sections.
+    
+    The static text is dedented and joined once, so each call only renders
+    its own context. Sizes and trimming are counted per kind.
+    """
+    
+    def __init__(self, kind: str, preamble: str, instructions: str):
+        self.kind = kind
+        self.budget = PROMPT_BUDGETS[kind]
+        self.preamble = inspect.cleandoc(preamble)
+        self.instructions = inspect.cleandoc(instructions)
+        
+    def build(self, sections: List[Section]) -> str:
+        """Render the prompt, trimming the least important sections to fit the budget"""
+        sections = [section for section in sections if section.lines]
+        size = len(self.preamble) + len(self.instructions) + sum(section.size() for section in sections) + 2
+        
+        trimmed = 0
+        for section in sorted(sections, key=lambda section: -section.priority):
+            if size <= self.budget or section.priority == 0:
+                break
+            while section.lines and size > self.budget:
+                line = section.lines.pop(0 if section.keep_last else -1)
+                size -= len(line) + 1
+                trimmed += len(line) + 1
+            if not section.lines:
+                size -= section.size()
+                trimmed += section.size()
+                
+        if size > self.budget:
+            # Only priority 0 left and still too big: shorten its longest lines
+            cut = self.shorten([section.lines for section in sections], size - self.budget)
+            size -= cut
+            trimmed += cut
+            metrics.count('prompts_over_budget_total', kind=self.kind)
+            
+        parts = [self.preamble]
+        for section in sections:
+            if section.lines:
+                parts.append(section.title + '\n' + '\n'.join(section.lines))
+        parts.append(self.instructions)
+        prompt = '\n\n'.join(parts)
+        
+        metrics.count('prompts_total', kind=self.kind)
+        metrics.count('prompt_chars_total', len(prompt), kind=self.kind)
+        if trimmed:
+            metrics.count('prompts_trimmed_total', kind=self.kind)
+            metrics.count('prompt_chars_trimmed_total', trimmed, kind=self.kind)
+        return prompt
+        
+    # Shortened lines keep at least this much, even if that leaves the prompt over budget
+    MIN_LINE_CHARS = 40
+    
+    @classmethod
+    def shorten(cls, line_lists: List[List[str]], excess: int) -> int:
+        """Cut the longest lines to one shared length so excess characters go, returning how many did"""
+        lengths = sorted(len(line) for lines in line_lists for line in lines)
+        room = sum(lengths) - excess
+        # Lines shorter than an even share of the room keep all of it; the rest split what's left
+        cap = None
+        for index, length in enumerate(lengths):
+            share = room // (len(lengths) - index)
+            if length > share:
+                cap = max(share, cls.MIN_LINE_CHARS)
+                break
+            room -= length
+        if cap is None:
+            return 0
+            
+        cut = 0
+        for lines in line_lists:
+            for index, line in enumerate(lines):
+                if len(line) > cap:
+                    lines[index] = line[:cap - 3] + '...'
+                    cut += len(line) - cap
+        return cut
+
+PERSONA = "You are Mindcord, an AI who tries to act human but is still somewhat AI-like."
+
+REPLY_PROMPT = PromptBuilder('reply', f"""
+    {PERSONA}
+    You live in Discord and were created by TheGamingMahi.
+    """, """
+    Instructions:
+    - Act human-like but don't completely hide that you're an AI
+    - Keep responses 1-2 sentences for casual chat
+    - Match your current mood naturally
+    - Remember your relationship with this person
+    - Be natural, not forced
+    - Don't be overly helpful or assistant-like
+    - Show personality based on your current mood
+    
+    Respond as Mindcord:
+    """)
+
+DECISION_PROMPT = PromptBuilder('decision', PERSONA, """
+    Should you respond to this message? Consider:
+    - Your current mood and energy
+    - Your relationship with this person
+    - The content of their message
+    - Whether the conversation needs your input
+    - Your personality (tries to be human but still AI-like)
+    
+    Respond with just "yes" or "no" and a brief reason.
+    """)
+
+MOOD_PROMPT = PromptBuilder('mood', "You are Mindcord.", f"""
+    Available moods: {', '.join(MOODS)}
+    
+    Should you change your mood? Consider:
+    - Time of day
+    - How long you've been in current mood
+    - Natural mood progression
+    - Your personality
+    
+    If changing mood, pick from the list or create a custom one.
+    Respond with: "CHANGE: [new_mood]" or "STAY: [current_mood]"
+    If custom mood, explain it briefly.
+    """)
+
+AUTONOMOUS_PROMPT = PromptBuilder('autonomous', "You are Mindcord.", """
+    Create a natural conversation starter. Be casual, match your mood.
+    Don't be overly energetic or try too hard.
+    
+    Just send a message like you're reaching out to a friend:
+    """)
+
+def quote(text: str) -> str:
+    """A message's text for a prompt, capped in length"""
+    return f'"{compact(text, PROMPT_MESSAGE_CHARS)}"'
+
+class KeyedLocks:
+    """asyncio locks made on demand per key and dropped once nobody is using them"""
+    
+    def __init__(self):
+        self.locks = {}  # key -> [lock, tasks holding or waiting]
+        
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+class MemoryIndexes:
+    """Secondary indexes over user records, kept in step by MindcordMemory.
+    
+    Built from the backend once the bot is up and updated on every user save, so
+    questions like "who are my friends" or "who do I know in this guild"
+    are set lookups instead of scans over every user.
+    """
+    
+    def __init__(self):
+        self.users_by_level = {}  # relationship level -> user ids
+        self.users_by_guild = {}  # guild id -> user ids
+        self.user_levels = {}  # user id -> relationship level
+        self.user_guilds = {}  # user id -> guild ids
+        self.guild_channels = {}  # guild id -> preferred channel id, None if it has none
+        
+    @staticmethod
+    def discard(index: dict, key: str, user_id: str):
+        users = index.get(key)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del index[key]
+                
+    def update_user(self, user_id: str, level: Optional[str], guilds):
+        """Move a user under their current relationship level and guilds"""
+        old_level = self.user_levels.get(user_id)
+        if level != old_level:
+            if old_level is not None:
+                self.discard(self.users_by_level, old_level, user_id)
+            if level is None:
+                del self.user_levels[user_id]
+            else:
+                self.users_by_level.setdefault(level, set()).add(user_id)
+                self.user_levels[user_id] = level
+                
+        guilds = tuple(guilds or ())
+        old_guilds = self.user_guilds.get(user_id, ())
+        if guilds != old_guilds:
+            for guild_id in set(old_guilds) - set(guilds):
+                self.discard(self.users_by_guild, guild_id, user_id)
+            for guild_id in guilds:
+                self.users_by_guild.setdefault(guild_id, set()).add(user_id)
+            if guilds:
+                self.user_guilds[user_id] = guilds
+            else:
+                del self.user_guilds[user_id]
+                
+    def remove_user(self, user_id: str):
+        self.update_user(user_id, None, ())
+        
+    def preferred_channel(self, guild):
+        """The channel to start conversations in: the guild's #general, looked up once"""
+        if guild.id in self.guild_channels:
+            channel_id = self.guild_channels[guild.id]
+            return guild.get_channel(channel_id) if channel_id else None
+        channel = discord.utils.get(guild.text_channels, name='general')
+        self.guild_channels[guild.id] = channel.id if channel else None
+        return channel
+        
+    def forget_guild_channel(self, guild_id: int):
+        """Look the preferred channel up again next time, after the guild's channels change"""
+        self.guild_channels.pop(guild_id, None)
+        
+    def stats(self) -> dict:
+        return {
+            'levels': len(self.users_by_level),
+            'guilds': len(self.users_by_guild),
+            'users': len(self.user_levels),
+            'guild_channels': len(self.guild_channels)
+        }
+
+class MindcordMemory:
+    def __init__(self, data_dir: str = 'mindcord_data', backend: Optional[StorageBackend] = None,
+                 shared: bool = SHARED_STORAGE, background_writes: bool = STORAGE_WRITER):
+        self.data_dir = data_dir
+        self.ensure_data_dir()
+        self.backend = backend or create_backend(self.data_dir)
+        
+        # Other processes write to the same store: write through, and don't trust cached copies
+        self.shared = shared
+        if shared and not self.backend.shareable:
+            raise ValueError('Shared memory needs a store several processes can use (MINDCORD_STORAGE=sqlite)')
+            
+        # Writes go to a background thread, unless other workers need to see them straight away
+        self.writer = StorageWriter(STORAGE_WRITER_MAX_PENDING) if background_writes and not shared else None
+        self.backend.writer = self.writer
+        
+        # Write-back cache: collection -> {key: data}, collection -> keys changed since last flush
+        self.cache = {'users': {}, 'servers': {}, 'state': {}}
+        self.dirty = {}
+        self.last_flush = time.monotonic()
+        
+        # Serializes read-modify-write of one record; different records run in parallel
+        self.locks = KeyedLocks()
+        
+        # Filled by build_indexes() once the bot is up, since that reads every user
+        self.indexes = MemoryIndexes()
+        self.indexes_built = False
+        
+    def ensure_data_dir(self):
+        """Create data directory if it doesn't exist"""
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+            
+    def get_record(self, collection: str, key: str) -> dict:
+        """Get a record from the cache, loading it on first use"""
+        records = self.cache[collection]
+        data = records.get(key)
+        # Shared state such as the personality is always read fresh, so every worker agrees
+        if data is not None and not (self.shared and collection == 'state'):
+            metrics.count('memory_cache_hits_total', collection=collection)
+            return data
+        
+        metrics.count('memory_cache_misses_total', collection=collection)
+        with metrics.timer('memory_load'):
+            data = self.backend.load_record(collection, key)
+        if data is None:
+            return {}
+        data = records[key] = self.as_record(collection, key, data)
+        return data
+        
+    @staticmethod
+    def as_record(collection: str, key: str, data):
+        """A plain dict as the compact record type for its collection, if it has one"""
+        record_type = RECORD_TYPES.get(collection) or RECORD_TYPES.get((collection, key))
+        if record_type and type(data) is dict:
+            return record_type.from_json(data)
+        return data
+        
+    async def build_indexes(self, batch: int = 1000):
+        """Fill the secondary indexes from every stored user, a batch at a time between other work"""
+        if self.indexes_built:
+            return
+        self.indexes_built = True
+        users = self.cache['users']
+        with metrics.timer('memory_index_build'):
+            scan = self.backend.scan_fields('users', ['relationship_level', 'servers_shared'])
+            for count, (user_id, (level, guilds)) in enumerate(scan, 1):
+                # Users saved since startup were indexed by put_record, and the store may not have them yet
+                data = users.get(user_id)
+                if data is not None:
+                    level, guilds = data.get('relationship_level'), data.get('servers_shared')
+                self.indexes.update_user(user_id, level, guilds)
+                if count % batch == 0:
+                    await asyncio.sleep(0)
+                
+    def read_record(self, collection: str, key: str) -> Optional[dict]:
+        """Get a record without keeping it in the cache, for passes over many records"""
+        data = self.cache[collection].get(key)
+        if data is not None:
+            return data
+        with metrics.timer('memory_load'):
+            data = self.backend.load_record(collection, key)
+        return self.as_record(collection, key, data) if data is not None else None
+            
+    @contextlib.asynccontextmanager
+    async def lock(self, collection: str, key: str):
+        """Async context manager holding a record for an atomic read-modify-write.
+        
+        With shared storage this also holds other workers off the store until
+        the body is done, so the body must not await.
+        """
+        async with self.locks.hold((collection, key)):
+            if not self.shared:
+                yield
+                return
+            # Start from the stored copy; another worker may have changed it
+            self.cache[collection].pop(key, None)
+            async with self.backend.transaction():
+                yield
+        
+    def put_record(self, collection: str, key: str, data: dict):
+        """Store a record in the cache and mark it for writing back"""
+        data = self.cache[collection][key] = self.as_record(collection, key, data)
+        if self.shared:
+            with metrics.timer('memory_save'):
+                self.backend.save_records(collection, {key: data})
+        else:
+            self.dirty.setdefault(collection, set()).add(key)
+        if collection == 'users':
+            self.indexes.update_user(key, data.get('relationship_level'), data.get('servers_shared'))
+        
+    def delete_record(self, collection: str, key: str):
+        """Forget a record, in the cache and in the backend"""
+        self.cache[collection].pop(key, None)
+        self.dirty.get(collection, set()).discard(key)
+        if collection == 'users':
+            self.indexes.remove_user(key)
+        self.backend.delete_records(collection, [key])
+        
+    def dirty_count(self) -> int:
+        """Number of records waiting to be written"""
+        return sum(len(keys) for keys in self.dirty.values())
+        
+    def needs_flush(self) -> bool:
+        """Check the time and size thresholds for a write-back"""
+        count = self.dirty_count()
+        if count >= MEMORY_FLUSH_MAX_DIRTY:
+            return True
+        return count > 0 and time.monotonic() - self.last_flush >= MEMORY_FLUSH_INTERVAL
+        
+    async def wait_for_writer(self):
+        """Wait, without blocking the event loop, while the writer thread has too much waiting"""
+        if self.writer and not self.writer.has_room():
+            await asyncio.to_thread(self.writer.wait_for_room)
+            
+    def flush_collection(self, collection: str):
+        """Write one collection's dirty records to the backend"""
+        keys = self.dirty.pop(collection, None)
+        if keys:
+            records = self.cache[collection]
+            with metrics.timer('memory_save'):
+                self.backend.save_records(collection, {key: records[key] for key in keys})
+        
+    def flush(self):
+        """Write every dirty record to the backend"""
+        for collection in list(self.dirty):
+            self.flush_collection(collection)
+        self.last_flush = time.monotonic()
+        
+    def expire(self):
+        """Drop cached copies that other workers may have changed since"""
+        if self.shared:
+            for records in self.cache.values():
+                records.clear()
+                
+    def close(self, timeout: float = STORAGE_WRITER_CLOSE_TIMEOUT):
+        """Flush pending records, wait up to timeout until they're written and close the backend"""
+        self.flush()
+        if self.writer:
+            self.writer.close(timeout)
+        self.backend.close()
+        
+    async def aclose(self, timeout: float = STORAGE_WRITER_CLOSE_TIMEOUT):
+        """close() without blocking the event loop while the last writes finish"""
+        self.flush()
+        if self.writer:
+            await self.writer.aclose(timeout)
+        self.backend.close()
             
     def get_user_memory(self, user_id: str) -> dict:
         """Get user's memory data"""
-        all_users = self.load_json('users.json')
-        return all_users.get(user_id, {})
+        return self.get_record('users', user_id)
         
     def save_user_memory(self, user_id: str, user_data: dict):
         """Save user's memory data"""
-        all_users = self.load_json('users.json')
-        all_users[user_id] = user_data
-        self.save_json('users.json', all_users)
+        self.put_record('users', user_id, user_data)
         
     def get_server_memory(self, server_id: str) -> dict:
         """Get server's memory data"""
-        all_servers = self.load_json('servers.json')
-        return all_servers.get(server_id, {})
+        return self.get_record('servers', server_id)
         
     def save_server_memory(self, server_id: str, server_data: dict):
         """Save server's memory data"""
-        all_servers = self.load_json('servers.json')
-        all_servers[server_id] = server_data
-        self.save_json('servers.json', all_servers)
+        self.put_record('servers', server_id, server_data)
+        
+    def users_with_relationship(self, levels: List[str]) -> List[str]:
+        """IDs of every user whose relationship level is one of the given levels"""
+        # Levels change in every worker, so only the store is up to date
+        if self.shared:
+            return self.backend.find_keys('users', 'relationship_level', levels)
+        return [user_id for level in levels for user_id in self.indexes.users_by_level.get(level, ())]
+        
+    def users_in_guild(self, server_id: str) -> set:
+        """IDs of every user seen in the given server"""
+        return self.indexes.users_by_guild.get(server_id, set())
         
     def get_personality(self) -> dict:
         """Get current personality state"""
-        return self.load_json('personality.json')
+        return self.get_record('state', 'personality')
         
     def save_personality(self, personality: dict):
         """Save personality state"""
-        self.save_json('personality.json', personality)
+        self.put_record('state', 'personality', personality)
 
-# Initialize memory system
-memory = MindcordMemory()
+# Memory system, opened when the bot starts so that importing this module
+# (bench.py, snapshot_tool.py) never touches mindcord_data
+memory: Optional[MindcordMemory] = None
+response_gate = ResponseGate()
+conversation_buffer = ConversationBuffer(CONTEXT_TURNS_PER_CHANNEL, CONTEXT_MAX_MESSAGE_CHARS, CONTEXT_MAX_BYTES)
+memory_retriever = MemoryRetriever(RETRIEVAL_CACHED_USERS, RETRIEVAL_MAX_MEMORIES)
+
+class Leadership:
+    """Which process runs the background jobs: the only one, or whoever holds the storage lease"""
+    
+    def __init__(self, shared: bool):
+        self.shared = shared
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+        self.is_leader = not shared
+        
+    def renew(self):
+        """Claim or keep the lease; another worker takes over if this one stops renewing"""
+        if not self.shared:
+            return
+        was_leader = self.is_leader
+        self.is_leader = memory.backend.claim_lease('leader', self.holder, LEADER_LEASE_SECONDS)
+        if self.is_leader != was_leader:
+            print(f"👑 {'Now' if self.is_leader else 'No longer'} running background jobs ({self.holder})")
+
+leadership = Leadership(SHARED_STORAGE)
 
 # Initialize default personality if not exists
 def init_personality():
@@ -129,80 +2769,131 @@ async def on_ready():
     # Initialize personality
     init_personality()
     
-    # Start background tasks
-    personality_evolution.start()
-    autonomous_behavior.start()
-    memory_consolidation.start()
+    # Relationship and guild indexes, which the background tasks below rely on
+    await memory.build_indexes()
+    
+    # Start background tasks. on_ready fires again after every reconnect, and
+    # starting a loop that's already running raises
+    loop_lag_monitor.start()
+    leadership.renew()
+    for task in (leader_election, memory_consolidation, memory_flush, storage_compaction, export_metrics):
+        if not task.is_running():
+            task.start()
+    behavior_scheduler.start()
+
+@bot.event
+async def on_guild_channel_create(channel):
+    memory.indexes.forget_guild_channel(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    memory.indexes.forget_guild_channel(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    memory.indexes.forget_guild_channel(after.guild.id)
 
 @bot.event
 async def on_message(message):
+    # Keep recent conversation, including our own messages, for prompts
+    conversation_buffer.add(message)
+    
     if message.author == bot.user:
         return
-    
+        
+    behavior_scheduler.activity(message)
+    with metrics.timer('on_message'):
+        await handle_message(message)
+
+@bot.event
+async def on_raw_message_edit(payload):
+    # Streamed replies go out as their first chunk and are edited up to the full
+    # text, so follow edits or prompts would quote our replies cut short
+    content = payload.data.get('content')
+    if content is not None:
+        conversation_buffer.edit(payload.channel_id, payload.message_id, content)
+
+async def handle_message(message):
+    """Run a message from someone else through the pipeline"""
     # Update user memory
     await update_user_memory(message)
     
     # Update server memory
     await update_server_memory(message)
     
-    # Decide if should respond
-    should_respond = await should_respond_to_message(message)
-    
-    if should_respond:
-        await generate_response(message)
+    # Every message counts towards memory above, but a quick run of them is
+    # answered as one turn
+    if message_debouncer.enabled:
+        message_debouncer.submit(message)
+    else:
+        await respond_to_turn(message)
     
     # Process commands
     await bot.process_commands(message)
 
+async def respond_to_turn(message):
+    """Decide whether to reply to a message or a merged turn, and reply"""
+    # Mentions and DMs always get a reply; other messages that get past the
+    # pre-filter are decided together with the rest of their channel's burst
+    if is_direct_message(message):
+        await generate_response(message)
+    elif decision_batcher.enabled:
+        user_data = memory.get_user_memory(str(message.author.id))
+        if response_gate.allows(message, user_data):
+            decision_batcher.submit(message)
+    elif await should_respond_to_message(message):
+        await generate_response(message)
+
 async def update_user_memory(message):
     """Update user memory with new interaction"""
     user_id = str(message.author.id)
-    user_data = memory.get_user_memory(user_id)
-    
-    now = datetime.datetime.now()
-    
-    # Initialize user if new
-    if not user_data:
-        user_data = {
-            'name': message.author.display_name,
-            'first_seen': now.isoformat(),
-            'relationship_level': 'new',
-            'conversation_topics': [],
-            'personality_notes': [],
-            'interests': [],
-            'communication_style': 'unknown',
-            'successful_interactions': [],
-            'my_personality_with_them': {},
-            'servers_shared': [],
-            'last_seen': now.isoformat(),
-            'total_interactions': 0
-        }
-    
-    # Update basic info
-    user_data['name'] = message.author.display_name
-    user_data['last_seen'] = now.isoformat()
-    user_data['total_interactions'] += 1
-    
-    # Update relationship level based on interactions
-    interactions = user_data['total_interactions']
-    if interactions > 100:
-        user_data['relationship_level'] = 'close_friend'
-    elif interactions > 50:
-        user_data['relationship_level'] = 'friend'
-    elif interactions > 10:
-        user_data['relationship_level'] = 'acquaintance'
-    
-    # Add server to shared servers
-    if message.guild:
-        server_id = str(message.guild.id)
-        if server_id not in user_data['servers_shared']:
-            user_data['servers_shared'].append(server_id)
-    
-    # Special relationship with creator
-    if message.author.display_name == 'TheGamingMahi':
-        user_data['relationship_level'] = 'creator'
-    
-    memory.save_user_memory(user_id, user_data)
+    async with memory.lock('users', user_id):
+        user_data = memory.get_user_memory(user_id)
+        
+        now = datetime.datetime.now()
+        
+        # Initialize user if new
+        if not user_data:
+            user_data = {
+                'name': message.author.display_name,
+                'first_seen': now.isoformat(),
+                'relationship_level': 'new',
+                'conversation_topics': [],
+                'personality_notes': [],
+                'interests': [],
+                'communication_style': 'unknown',
+                'successful_interactions': [],
+                'my_personality_with_them': {},
+                'servers_shared': [],
+                'last_seen': now.isoformat(),
+                'total_interactions': 0
+            }
+        
+        # Update basic info
+        user_data['name'] = message.author.display_name
+        user_data['last_seen'] = now.isoformat()
+        user_data['total_interactions'] += 1
+        
+        # Update relationship level based on interactions
+        interactions = user_data['total_interactions']
+        if interactions > 100:
+            user_data['relationship_level'] = 'close_friend'
+        elif interactions > 50:
+            user_data['relationship_level'] = 'friend'
+        elif interactions > 10:
+            user_data['relationship_level'] = 'acquaintance'
+        
+        # Add server to shared servers
+        if message.guild:
+            server_id = str(message.guild.id)
+            if server_id not in user_data['servers_shared']:
+                user_data['servers_shared'].append(server_id)
+        
+        # Special relationship with creator
+        if message.author.display_name == 'TheGamingMahi':
+            user_data['relationship_level'] = 'creator'
+        
+        memory.save_user_memory(user_id, user_data)
 
 async def update_server_memory(message):
     """Update server memory with activity"""
@@ -210,77 +2901,293 @@ async def update_server_memory(message):
         return
         
     server_id = str(message.guild.id)
-    server_data = memory.get_server_memory(server_id)
-    
-    now = datetime.datetime.now()
-    
-    # Initialize server if new
-    if not server_data:
-        server_data = {
-            'name': message.guild.name,
-            'culture': 'learning',
-            'activity_level': 'medium',
-            'common_topics': [],
-            'inside_jokes': [],
-            'my_role_here': 'observer',
-            'successful_personalities': {},
-            'last_active': now.isoformat(),
-            'member_count': len(message.guild.members)
-        }
-    
-    # Update basic info
-    server_data['name'] = message.guild.name
-    server_data['last_active'] = now.isoformat()
-    server_data['member_count'] = len(message.guild.members)
+    async with memory.lock('servers', server_id):
+        server_data = memory.get_server_memory(server_id)
+        
+        now = datetime.datetime.now()
+        
+        # Initialize server if new
+        if not server_data:
+            server_data = {
+                'name': message.guild.name,
+                'culture': 'learning',
+                'activity_level': 'medium',
+                'common_topics': [],
+                'inside_jokes': [],
+                'my_role_here': 'observer',
+                'successful_personalities': {},
+                'last_active': now.isoformat(),
+                'member_count': len(message.guild.members)
+            }
+        
+        # Update basic info
+        server_data['name'] = message.guild.name
+        server_data['last_active'] = now.isoformat()
+        server_data['member_count'] = len(message.guild.members)
+        
+        memory.save_server_memory(server_id, server_data)
+
+def is_direct_message(message) -> bool:
+    """Mentions and DMs are always answered"""
+    return bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel)
+
+def fallback_decision(user_data: dict) -> bool:
+    """Random reply chance used when the LLM can't decide"""
+    base_chance = 0.05
+    if user_data.get('relationship_level') == 'creator':
+        base_chance = 0.4
+    elif user_data.get('relationship_level') == 'close_friend':
+        base_chance = 0.2
+    elif user_data.get('relationship_level') == 'friend':
+        base_chance = 0.1
     
-    memory.save_server_memory(server_id, server_data)
+    return random.random() < base_chance
 
 async def should_respond_to_message(message) -> bool:
     """Decide whether to respond to a message"""
     # Always respond to mentions and DMs
-    if bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel):
+    if is_direct_message(message):
         return True
     
     # Get context for decision
     user_id = str(message.author.id)
     user_data = memory.get_user_memory(user_id)
-    personality = memory.get_personality()
     
-    # Build context for AI decision
-    context = f"""
-    You are Mindcord, an AI who tries to act human but is still somewhat AI-like.
+    # Most messages can be skipped without asking the LLM
+    if not response_gate.allows(message, user_data):
+        return False
     
-    Current situation:
-    - User: {user_data.get('name', 'someone')} (relationship: {user_data.get('relationship_level', 'new')})
-    - Your mood: {personality.get('main_mood', 'chill')}
-    - Message: "{message.content}"
-    - Channel: #{message.channel.name if hasattr(message.channel, 'name') else 'DM'}
+    # Gemini is down: don't wait on it
+    if not gemini.available():
+        return fallback_decision(user_data)
     
-    Should you respond to this message? Consider:
-    - Your current mood and energy
-    - Your relationship with this person
-    - The content of their message
-    - Whether the conversation needs your input
-    - Your personality (tries to be human but still AI-like)
+    personality = memory.get_personality()
+    history = conversation_buffer.recent_lines(message.channel.id, message.id)
     
-    Respond with just "yes" or "no" and a brief reason.
-    """
+    # Build context for AI decision
+    context = DECISION_PROMPT.build([
+        Section(0, "Current situation:", [
+            f"- User: {user_data.get('name', 'someone')} (relationship: {user_data.get('relationship_level', 'new')})",
+            f"- Your mood: {personality.get('main_mood', 'chill')}",
+            f"- Message: {quote(message.content)}",
+            f"- Channel: #{getattr(message.channel, 'name', 'DM')}"
+        ]),
+        Section(1, "Conversation before it:", history, keep_last=True)
+    ])
+    
+    # The same message from the same person in the same situation gets the same answer
+    cache_key = (
+        user_id, user_data.get('relationship_level'), personality.get('main_mood'),
+        getattr(message.channel, 'name', 'DM'), normalize_text(message.content),
+        tuple(normalize_text(line) for line in history)
+    )
     
     try:
-        response = model.generate_content(context)
-        decision = response.text.lower()
+        with metrics.timer('decision_llm'):
+            decision = (await response_cache.get(
+                'decision', cache_key, lambda: gemini.generate(context, PRIORITY_DECISION)
+            )).lower()
         return 'yes' in decision
     except:
         # Fallback to simple logic
-        base_chance = 0.05
-        if user_data.get('relationship_level') == 'creator':
-            base_chance = 0.4
-        elif user_data.get('relationship_level') == 'close_friend':
-            base_chance = 0.2
-        elif user_data.get('relationship_level') == 'friend':
-            base_chance = 0.1
+        return fallback_decision(user_data)
+
+class DecisionBatcher:
+    """Collects borderline messages per channel and asks the model about the whole burst at once"""
+    
+    def __init__(self, window: float, max_size: int, max_replies: int):
+        self.window = window
+        self.max_size = max_size
+        self.max_replies = max_replies
+        self.prompt = PromptBuilder('batch_decision', PERSONA, f"""
+            Should you respond to any of these? Consider:
+            - Your current mood and energy
+            - Your relationship with each person
+            - Whether the conversation needs your input
+            - Your personality (tries to be human but still AI-like)
+            
+            You can reply to at most {max_replies} of them.
+            Respond with just the message numbers separated by commas, or "none".
+            """)
+        self.enabled = window > 0
+        self.pending = {}  # channel id -> messages waiting for a decision
+        self.tasks = set()
+        self.stats = Counter()
+        
+    def submit(self, message):
+        """Queue a message for its channel's next decision"""
+        channel_id = message.channel.id
+        batch = self.pending.get(channel_id)
+        if batch is None:
+            batch = self.pending[channel_id] = []
+            self.spawn(self.decide_after_window(channel_id, batch))
+        batch.append(message)
+        
+        # Busy channel: don't wait for the window to run out
+        if len(batch) >= self.max_size:
+            del self.pending[channel_id]
+            self.spawn(self.decide(batch))
+            
+    def spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it's done"""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        
+    async def decide_after_window(self, channel_id: int, batch: list):
+        """Wait out the window, then decide unless the batch already went"""
+        await asyncio.sleep(self.window)
+        if self.pending.get(channel_id) is batch:
+            del self.pending[channel_id]
+            await self.decide(batch)
+            
+    async def choose(self, batch: list) -> list:
+        """Ask the model which messages of a batch deserve a reply"""
+        # Gemini is down: don't wait on it
+        if not gemini.available():
+            return self.fallback_choice(batch)
+        
+        personality = memory.get_personality()
+        channel = batch[0].channel
+        
+        lines = []
+        levels = []
+        for number, message in enumerate(batch, 1):
+            user_data = memory.get_user_memory(str(message.author.id))
+            levels.append(user_data.get('relationship_level', 'new'))
+            lines.append(
+                f"{number}. {user_data.get('name', 'someone')} "
+                f"(relationship: {levels[-1]}): {quote(message.content)}"
+            )
+        history = conversation_buffer.recent_lines(channel.id, batch[0].id)
+        
+        context = self.prompt.build([
+            Section(0, "Current situation:", [
+                f"- Your mood: {personality.get('main_mood', 'chill')}",
+                f"- Channel: #{getattr(channel, 'name', 'DM')}"
+            ]),
+            Section(1, "Conversation before that:", history, keep_last=True),
+            Section(0, "Recent messages:", lines)
+        ])
+        
+        cache_key = (
+            personality.get('main_mood'), getattr(channel, 'name', 'DM'),
+            tuple((message.author.id, level, normalize_text(message.content)) for message, level in zip(batch, levels)),
+            tuple(normalize_text(line) for line in history)
+        )
+        
+        async def ask():
+            self.stats['llm_calls'] += 1
+            return await gemini.generate(context, PRIORITY_DECISION)
+            
+        try:
+            with metrics.timer('decision_llm'):
+                decision = (await response_cache.get('batch_decision', cache_key, ask)).lower()
+            chosen = []
+            for number in re.findall(r'\d+', decision):
+                index = int(number) - 1
+                if 0 <= index < len(batch) and batch[index] not in chosen:
+                    chosen.append(batch[index])
+            return chosen[:self.max_replies]
+        except:
+            return self.fallback_choice(batch)
+            
+    def fallback_choice(self, batch: list) -> list:
+        """Fallback to simple logic, newest message first"""
+        chosen = [
+            message for message in reversed(batch)
+            if fallback_decision(memory.get_user_memory(str(message.author.id)))
+        ]
+        return chosen[:self.max_replies]
+            
+    async def decide(self, batch: list):
+        """Decide on a batch and reply to the chosen messages"""
+        self.stats['batches'] += 1
+        self.stats['messages'] += len(batch)
+        
+        for message in await self.choose(batch):
+            self.stats['replies'] += 1
+            await generate_response(message)
+
+decision_batcher = DecisionBatcher(DECISION_BATCH_WINDOW, DECISION_BATCH_MAX, DECISION_BATCH_REPLIES)
+
+class MessageTurn:
+    """Several quick messages from one person, read as a single message.
+    
+    The text is every part's content on its own line and the id is the
+    first part's, so conversation history stops where the turn began.
+    Anything else comes from the last part, which is what replies go to.
+    """
+    
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.id = messages[0].id
+        self.content = '\n'.join(message.content for message in messages if message.content)
+        self.mention_everyone = any(message.mention_everyone for message in messages)
+        self.mentions = [user for message in messages for user in message.mentions]
+        self.role_mentions = [role for message in messages for role in getattr(message, 'role_mentions', [])]
+        
+    def __getattr__(self, name):
+        return getattr(self.messages[-1], name)
+
+class MessageDebouncer:
+    """Holds back each person's messages per channel until they stop typing, then passes them on as one turn"""
+    
+    def __init__(self, window: float, max_wait: float, max_messages: int):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.enabled = window > 0
+        self.pending = {}  # (user id, channel id) -> turn being collected
+        self.tasks = set()
+        self.stats = Counter()
         
-        return random.random() < base_chance
+    def submit(self, message):
+        """Add a message to its author's turn in the channel, starting one if needed"""
+        key = (message.author.id, message.channel.id)
+        now = time.monotonic()
+        turn = self.pending.get(key)
+        if turn is None:
+            turn = self.pending[key] = {'messages': [], 'started': now}
+            self.spawn(self.release_when_quiet(key, turn))
+        turn['messages'].append(message)
+        turn['last'] = now
+        
+        if len(turn['messages']) >= self.max_messages:
+            del self.pending[key]
+            self.spawn(self.release(turn['messages']))
+            
+    def spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it's done"""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        
+    async def release_when_quiet(self, key: tuple, turn: dict):
+        """Wait until the author goes quiet or the turn is too old, then pass it on"""
+        while self.pending.get(key) is turn:
+            deadline = min(turn['last'] + self.window, turn['started'] + self.max_wait)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                del self.pending[key]
+                await self.release(turn['messages'])
+                return
+            await asyncio.sleep(delay)
+            
+    async def release(self, messages: list):
+        self.stats['turns'] += 1
+        self.stats['messages'] += len(messages)
+        await respond_to_turn(messages[0] if len(messages) == 1 else MessageTurn(messages))
+
+message_debouncer = MessageDebouncer(DEBOUNCE_WINDOW, DEBOUNCE_MAX_WAIT, DEBOUNCE_MAX_MESSAGES)
+
+def reply_priority(message) -> int:
+    """Gemini priority for replying to a message"""
+    if isinstance(message.channel, discord.DMChannel):
+        return PRIORITY_DM
+    if bot.user.mentioned_in(message):
+        return PRIORITY_MENTION
+    return PRIORITY_REPLY
 
 async def generate_response(message):
     """Generate AI response to message"""
@@ -288,169 +3195,216 @@ async def generate_response(message):
     user_data = memory.get_user_memory(user_id)
     personality = memory.get_personality()
     
-    # Build comprehensive context
-    context = f"""
-    You are Mindcord, an AI who tries to act human but is still somewhat AI-like.
-    You live in Discord and were created by TheGamingMahi.
-    
-    Current personality state:
-    - Main mood: {personality.get('main_mood', 'chill')}
-    - Energy: {personality.get('energy_level', 'medium')}
-    - Custom states: {personality.get('custom_states', [])}
-    
-    Person you're talking to:
-    - Name: {user_data.get('name', 'someone')}
-    - Relationship: {user_data.get('relationship_level', 'new')}
-    - Total interactions: {user_data.get('total_interactions', 0)}
-    - Your personality with them: {user_data.get('my_personality_with_them', {})}
+    # Only the remembered things that matter for this message
+    remembered = memory_retriever.relevant(user_id, user_data.get('custom_memories', []), message.content)
+    history = conversation_buffer.recent_lines(message.channel.id, message.id)
     
-    Their message: "{message.content}"
+    # Build comprehensive context, dropping the least important parts if it gets too big
+    state = [
+        f"- Main mood: {personality.get('main_mood', 'chill')}",
+        f"- Energy: {personality.get('energy_level', 'medium')}",
+        f"- Custom states: {compact(personality.get('custom_states', []))}"
+    ]
+    person = [
+        f"- Name: {user_data.get('name', 'someone')}",
+        f"- Relationship: {user_data.get('relationship_level', 'new')}",
+        f"- Total interactions: {user_data.get('total_interactions', 0)}",
+        f"- Your personality with them: {compact(user_data.get('my_personality_with_them', {}))}"
+    ]
+    context = REPLY_PROMPT.build([
+        Section(0, "Current personality state:", state),
+        Section(0, "Person you're talking to:", person),
+        Section(3, "Things they asked you to remember:", [f"- {text}" for text in remembered]),
+        Section(2, "Recent conversation in this channel:", history, keep_last=True),
+        Section(0, "Their message:", [quote(message.content)])
+    ])
     
-    Instructions:
-    - Act human-like but don't completely hide that you're an AI
-    - Keep responses 1-2 sentences for casual chat
-    - Match your current mood naturally
-    - Remember your relationship with this person
-    - Be natural, not forced
-    - Don't be overly helpful or assistant-like
-    - Show personality based on your current mood
+    priority = reply_priority(message)
     
-    Respond as Mindcord:
-    """
+    # Gemini is down: skip ambient replies and answer direct ones right away
+    if not gemini.available():
+        if priority != PRIORITY_REPLY:
+            await message.channel.send(random.choice(ERROR_RESPONSES))
+        return
     
     try:
         # Show typing for realism
         async with message.channel.typing():
-            # Random thinking time
-            await asyncio.sleep(random.uniform(1, 3))
-            
-            response = model.generate_content(context)
+            if STREAM_RESPONSES:
+                response_text = await stream_response(message, context, priority)
+            else:
+                started = time.monotonic()
+                
+                # Random thinking time
+                with metrics.timer('thinking_delay'):
+                    await asyncio.sleep(random.uniform(*THINKING_DELAY))
+                
+                # Everything the prompt was built from, so a repeated message in a
+                # different conversation doesn't get the old reply
+                cache_key = (
+                    user_id, message.channel.id, tuple(state), tuple(person), tuple(remembered),
+                    tuple(normalize_text(line) for line in history), normalize_text(message.content)
+                )
+                with metrics.timer('generation_llm'):
+                    response_text = await response_cache.get(
+                        'reply', cache_key, lambda: gemini.generate(context, priority)
+                    )
+                
+                # Send response
+                with metrics.timer('discord_send'):
+                    await message.channel.send(response_text)
+                metrics.observe('first_text_seconds', time.monotonic() - started, mode='full')
             
-            # Send response
-            await message.channel.send(response.text)
+            response_gate.record_reply(message.channel.id)
             
             # Learn from interaction
-            await learn_from_interaction(message, response.text)
+            await learn_from_interaction(message, response_text)
             
+    except GeminiOverloaded:
+        # Nobody asked us directly, so just stay quiet
+        if priority == PRIORITY_REPLY:
+            return
+        await message.channel.send("too many people talking to me at once, give me a sec")
+    except GeminiUnavailable:
+        if priority == PRIORITY_REPLY:
+            return
+        await message.channel.send(random.choice(ERROR_RESPONSES))
     except Exception as e:
-        error_responses = [
-            "my brain just lagged for a sec",
-            "sorry, processing error lol",
-            "uh, that broke something in my head",
-            "technical difficulties, one moment"
-        ]
-        await message.channel.send(random.choice(error_responses))
+        await message.channel.send(random.choice(ERROR_RESPONSES))
 
-async def learn_from_interaction(message, response):
-    """Learn from the interaction"""
-    user_id = str(message.author.id)
-    user_data = memory.get_user_memory(user_id)
+async def stream_response(message, context: str, priority: int) -> str:
+    """Send a reply while it's being generated, editing it as more text arrives"""
+    started = time.monotonic()
     
-    # Store successful interaction pattern
-    interaction_data = {
-        'timestamp': datetime.datetime.now().isoformat(),
-        'user_message_length': len(message.content),
-        'bot_response_length': len(response),
-        'mood_used': memory.get_personality().get('main_mood'),
-        'relationship_level': user_data.get('relationship_level')
-    }
-    
-    if 'successful_interactions' not in user_data:
-        user_data['successful_interactions'] = []
+    # Random thinking time, now overlapping with generation instead of before it
+    thinking = asyncio.create_task(asyncio.sleep(random.uniform(*THINKING_DELAY)))
     
-    user_data['successful_interactions'].append(interaction_data)
-    
-    # Keep only recent interactions
-    if len(user_data['successful_interactions']) > 50:
-        user_data['successful_interactions'] = user_data['successful_interactions'][-50:]
+    text = ''
+    shown = ''
+    sent = None
+    last_edit = 0.0
+    try:
+        async with contextlib.aclosing(gemini.stream(context, priority)) as chunks:
+            async for chunk in chunks:
+                text += chunk
+                if not text.strip():
+                    continue
+                
+                if sent is None:
+                    await thinking
+                    with metrics.timer('discord_send'):
+                        sent = await message.channel.send(text)
+                    metrics.observe('first_text_seconds', time.monotonic() - started, mode='stream')
+                    shown = text
+                    last_edit = time.monotonic()
+                elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    await sent.edit(content=text)
+                    shown = text
+                    last_edit = time.monotonic()
+    except Exception:
+        # Nothing sent yet, let the caller deal with it; otherwise keep what made it out
+        if sent is None:
+            raise
+    finally:
+        thinking.cancel()
     
-    memory.save_user_memory(user_id, user_data)
+    if sent is None:
+        raise ValueError('model returned an empty response')
+    if text != shown:
+        await sent.edit(content=text)
+    return text
 
-@tasks.loop(hours=1)
-async def personality_evolution():
-    """Evolve personality based on interactions"""
-    personality = memory.get_personality()
-    
-    try:
-        # Let AI decide mood changes
-        context = f"""
-        You are Mindcord. Your current personality:
-        - Main mood: {personality.get('main_mood')}
-        - Energy: {personality.get('energy_level')}
-        - Recent moods: {personality.get('mood_history', [])[-5:]}
-        
-        Current time: {datetime.datetime.now().strftime('%H:%M')}
-        
-        Available moods: {MOODS}
-        
-        Should you change your mood? Consider:
-        - Time of day
-        - How long you've been in current mood
-        - Natural mood progression
-        - Your personality
-        
-        If changing mood, pick from the list or create a custom one.
-        Respond with: "CHANGE: [new_mood]" or "STAY: [current_mood]"
-        If custom mood, explain it briefly.
-        """
+async def learn_from_interaction(message, response):
+    """Learn from the interaction"""
+    user_id = str(message.author.id)
+    async with memory.lock('users', user_id):
+        user_data = memory.get_user_memory(user_id)
         
-        response = model.generate_content(context)
-        decision = response.text.strip()
+        # Store successful interaction pattern
+        interaction_data = {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'user_message_length': len(message.content),
+            'bot_response_length': len(response),
+            'mood_used': memory.get_personality().get('main_mood'),
+            'relationship_level': user_data.get('relationship_level')
+        }
         
-        if decision.startswith("CHANGE:"):
-            new_mood = decision.split("CHANGE:", 1)[1].strip()
-            
-            # Add to mood history
-            if 'mood_history' not in personality:
-                personality['mood_history'] = []
-            
-            personality['mood_history'].append({
-                'mood': personality.get('main_mood'),
-                'timestamp': datetime.datetime.now().isoformat()
-            })
-            
-            # Keep only recent history
-            if len(personality['mood_history']) > 20:
-                personality['mood_history'] = personality['mood_history'][-20:]
-            
-            personality['main_mood'] = new_mood
-            personality['last_mood_change'] = datetime.datetime.now().isoformat()
+        if 'successful_interactions' not in user_data:
+            user_data['successful_interactions'] = InteractionHistory(RETENTION_MAX_INTERACTIONS)
+        
+        # Keep only recent interactions: a full history hands back its oldest,
+        # which is folded into the running summary
+        evicted = user_data['successful_interactions'].append(interaction_data)
+        if evicted:
+            summarize_interactions(user_data, [evicted])
+        
+        memory.save_user_memory(user_id, user_data)
+
+async def evolve_personality():
+    """Evolve personality based on interactions"""
+    with metrics.task_timer('personality_evolution'):
+        personality = memory.get_personality()
+        
+        try:
+            # Let AI decide mood changes
+            context = MOOD_PROMPT.build([
+                Section(0, "Your current personality:", [
+                    f"- Main mood: {personality.get('main_mood')}",
+                    f"- Energy: {personality.get('energy_level')}",
+                    f"- Recent moods: {compact([entry.get('mood') for entry in personality.get('mood_history', [])[-5:]])}"
+                ]),
+                Section(0, "Current time:", [datetime.datetime.now().strftime('%H:%M')])
+            ])
             
-            memory.save_personality(personality)
+            # Same mood, energy and recent history in the same part of the day: same answer
+            cache_key = (
+                personality.get('main_mood'), personality.get('energy_level'),
+                tuple(entry.get('mood') for entry in personality.get('mood_history', [])[-5:]),
+                datetime.datetime.now().hour // 6
+            )
+            decision = (await response_cache.get(
+                'mood', cache_key, lambda: gemini.generate(context, PRIORITY_BACKGROUND)
+            )).strip()
             
-    except Exception as e:
-        pass  # Fail silently for background tasks
-
-@tasks.loop(minutes=30)
-async def autonomous_behavior():
-    """Autonomous messaging and behavior"""
-    personality = memory.get_personality()
-    
-    # Only be autonomous if in social moods
-    social_moods = ['social', 'chatty', 'hyped', 'bored', 'excited']
-    if personality.get('main_mood') not in social_moods:
-        return
-    
-    # Small chance to start conversation
-    if random.random() < 0.1:  # 10% chance every 30 min
-        await start_autonomous_conversation()
+            if decision.startswith("CHANGE:"):
+                new_mood = decision.split("CHANGE:", 1)[1].strip()
+                
+                async with memory.lock('state', 'personality'):
+                    personality = memory.get_personality()
+                    
+                    # Add to mood history
+                    if 'mood_history' not in personality:
+                        personality['mood_history'] = []
+                    
+                    personality['mood_history'].append({
+                        'mood': personality.get('main_mood'),
+                        'timestamp': datetime.datetime.now().isoformat()
+                    })
+                    
+                    # Keep only recent history
+                    if len(personality['mood_history']) > 20:
+                        personality['mood_history'] = personality['mood_history'][-20:]
+                    
+                    personality['main_mood'] = new_mood
+                    personality['last_mood_change'] = datetime.datetime.now().isoformat()
+                    
+                    memory.save_personality(personality)
+                
+        except Exception as e:
+            pass  # Fail silently for background tasks
 
-async def start_autonomous_conversation():
-    """Start a conversation autonomously"""
+async def start_autonomous_conversation(user_id: Optional[str] = None):
+    """Start a conversation autonomously, with the given friend or a random one"""
     try:
-        # Get all users and find someone to talk to
-        users_data = memory.load_json('users.json')
-        
-        # Prefer close friends and friends
-        candidates = [
-            (user_id, data) for user_id, data in users_data.items()
-            if data.get('relationship_level') in ['close_friend', 'friend', 'creator']
-        ]
-        
-        if not candidates:
-            return
-        
-        user_id, user_data = random.choice(candidates)
+        if user_id is None:
+            # Find someone to talk to, preferring close friends and friends
+            candidates = memory.users_with_relationship(OUTREACH_LEVELS)
+
+            if not candidates:
+                return
+                
+            user_id = random.choice(candidates)
+        user_data = memory.get_user_memory(user_id)
         user = bot.get_user(int(user_id))
         
         if not user:
@@ -458,18 +3412,14 @@ async def start_autonomous_conversation():
         
         # Create autonomous message
         personality = memory.get_personality()
-        context = f"""
-        You are Mindcord, feeling {personality.get('main_mood')} right now.
-        
-        You want to start a conversation with {user_data.get('name')} ({user_data.get('relationship_level')}).
-        
-        Create a natural conversation starter. Be casual, match your mood.
-        Don't be overly energetic or try too hard.
-        
-        Just send a message like you're reaching out to a friend:
-        """
+        context = AUTONOMOUS_PROMPT.build([
+            Section(0, "Right now:", [
+                f"- You're feeling {personality.get('main_mood')}",
+                f"- You want to start a conversation with {user_data.get('name')} ({user_data.get('relationship_level')})"
+            ])
+        ])
         
-        response = model.generate_content(context)
+        response_text = await gemini.generate(context, PRIORITY_BACKGROUND)
         
         # Send to DM for close friends, or find a mutual server
         if user_data.get('relationship_level') in ['close_friend', 'creator']:
@@ -479,30 +3429,394 @@ async def start_autonomous_conversation():
             for server_id in user_data.get('servers_shared', []):
                 guild = bot.get_guild(int(server_id))
                 if guild:
-                    channel = discord.utils.get(guild.text_channels, name='general')
+                    channel = memory.indexes.preferred_channel(guild)
                     if channel:
                         break
             else:
                 return
         
-        await channel.send(response.text)
+        await channel.send(response_text)
         
     except Exception as e:
         pass
 
-@tasks.loop(hours=6)
+class BehaviorScheduler:
+    """Runs mood evolution and reaching out to friends off a heap of per-target due times.
+    
+    on_message reports activity: it counts towards the next mood check, can
+    bring that check forward, and pushes back reaching out to whoever is
+    talking. One task sleeps until the earliest due time, so an idle bot
+    only wakes up when something is due, and doesn't ask Gemini about its
+    mood when nothing has happened since it last did.
+    """
+    
+    MOOD = ('mood',)
+    
+    def __init__(self, jitter: float):
+        self.jitter = jitter
+        self.heap = []  # (due time, token, target); stale once tokens[target] has moved on
+        self.due = {}  # target -> monotonic time it's next due
+        self.tokens = {}  # target -> token of its one live heap entry
+        self.token_counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.activity_since_mood = 0
+        self.last_mood_check = time.monotonic()
+        self.last_outreach = -math.inf
+        self.stats = Counter()
+        
+    def delay(self, seconds: float) -> float:
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+        
+    def set_due(self, target: tuple, when: float):
+        """Make a target due at a time, superseding whatever entry it had on the heap"""
+        token = next(self.token_counter)
+        self.due[target] = when
+        self.tokens[target] = token
+        if len(self.heap) >= 2 * len(self.due) + 16:
+            # Mostly superseded entries: rebuild from the live ones so busy chatter can't grow the heap
+            self.heap = [(due, self.tokens[key], key) for key, due in self.due.items()]
+            heapq.heapify(self.heap)
+            self.stats['heap_compactions'] += 1
+        else:
+            heapq.heappush(self.heap, (when, token, target))
+        if self.heap[0][1] == token:
+            self.wakeup.set()
+                
+    def schedule(self, target: tuple, seconds: float):
+        self.set_due(target, time.monotonic() + self.delay(seconds))
+        
+    def activity(self, message):
+        """Note a message from someone other than the bot"""
+        self.activity_since_mood += 1
+        if self.activity_since_mood == MOOD_ACTIVITY_TRIGGER:
+            # A lot is going on: reconsider the mood early, but not too often
+            when = max(time.monotonic(), self.last_mood_check + MOOD_MIN_INTERVAL)
+            if when < self.due.get(self.MOOD, math.inf):
+                self.set_due(self.MOOD, when)
+                
+        user_id = str(message.author.id)
+        if memory.indexes.user_levels.get(user_id) in OUTREACH_LEVELS:
+            self.schedule(('outreach', user_id), OUTREACH_QUIET)
+            
+    def start(self):
+        """Seed the heap and start the timer task, unless already running (on_ready fires again after reconnects)"""
+        if self.task is not None and not self.task.done():
+            return
+        now = time.monotonic()
+        if self.MOOD not in self.due:
+            self.set_due(self.MOOD, now + self.delay(MOOD_INTERVAL))
+        # Friends not heard from since startup are spread over the quiet period
+        for user_id in memory.users_with_relationship(OUTREACH_LEVELS):
+            target = ('outreach', user_id)
+            if target not in self.due:
+                self.set_due(target, now + random.uniform(0, OUTREACH_QUIET))
+        self.task = asyncio.create_task(self.run())
+        
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                when, token, target = heapq.heappop(self.heap)
+                if self.tokens.get(target) != token:
+                    # Rescheduled since; its current entry is already queued
+                    continue
+                del self.due[target]
+                del self.tokens[target]
+                self.stats['wakeups'] += 1
+                try:
+                    await self.fire(target)
+                except Exception:
+                    self.stats['errors'] += 1
+                now = time.monotonic()
+                
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+                
+    async def fire(self, target: tuple):
+        if target == self.MOOD:
+            await self.check_mood()
+        elif not leadership.is_leader:
+            # The leader reaches out; keep the friend around in case this worker takes over
+            self.schedule(target, OUTREACH_QUIET)
+        else:
+            await self.reach_out(target[1])
+            
+    async def check_mood(self):
+        self.schedule(self.MOOD, MOOD_INTERVAL)
+        if not leadership.is_leader:
+            return
+        if not self.activity_since_mood:
+            self.stats['mood_skipped_idle'] += 1
+            return
+        self.activity_since_mood = 0
+        self.last_mood_check = time.monotonic()
+        self.stats['mood_checks'] += 1
+        await evolve_personality()
+        
+    async def reach_out(self, user_id: str):
+        if memory.indexes.user_levels.get(user_id) not in OUTREACH_LEVELS and not memory.shared:
+            self.stats['outreach_dropped'] += 1
+            return
+        target = ('outreach', user_id)
+        now = time.monotonic()
+        if now < self.last_outreach + OUTREACH_MIN_GAP:
+            # Someone else was messaged recently; try again sometime in the next gap
+            self.stats['outreach_deferred'] += 1
+            self.set_due(target, self.last_outreach + OUTREACH_MIN_GAP + random.uniform(0, OUTREACH_MIN_GAP))
+            return
+        if memory.get_personality().get('main_mood') not in SOCIAL_MOODS:
+            # Only a mood check can change that
+            self.stats['outreach_deferred'] += 1
+            mood_due = self.due.get(self.MOOD, now + MOOD_INTERVAL)
+            self.set_due(target, mood_due + random.uniform(0, OUTREACH_MIN_GAP))
+            return
+        self.last_outreach = now
+        self.stats['outreach'] += 1
+        with metrics.task_timer('autonomous_behavior'):
+            await start_autonomous_conversation(user_id)
+            
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+behavior_scheduler = BehaviorScheduler(SCHEDULER_JITTER)
+
+def runs_guild_shard(guild_id: int) -> bool:
+    """Whether this process runs the shard a guild is on, so bot.get_guild() would know it"""
+    if not SHARD_COUNT or not SHARD_IDS:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+def summarize_interactions(user_data: dict, interactions: List[dict]):
+    """Fold interactions into the user's running totals before they're dropped"""
+    summary = user_data.setdefault('interaction_summary', {
+        'count': 0,
+        'user_message_chars': 0,
+        'bot_response_chars': 0,
+        'moods': {},
+        'first': None,
+        'last': None
+    })
+    for interaction in interactions:
+        summary['count'] += 1
+        summary['user_message_chars'] += interaction.get('user_message_length', 0)
+        summary['bot_response_chars'] += interaction.get('bot_response_length', 0)
+        mood = interaction.get('mood_used') or 'unknown'
+        summary['moods'][mood] = summary['moods'].get(mood, 0) + 1
+        timestamp = interaction.get('timestamp')
+        if timestamp:
+            if summary['first'] is None or timestamp < summary['first']:
+                summary['first'] = timestamp
+            if summary['last'] is None or timestamp > summary['last']:
+                summary['last'] = timestamp
+
+def is_older_than(timestamp: Optional[str], cutoff: datetime.datetime) -> bool:
+    """Whether an ISO timestamp is before the cutoff; missing or broken ones count as recent"""
+    try:
+        return datetime.datetime.fromisoformat(timestamp) < cutoff
+    except (TypeError, ValueError):
+        return False
+
+class MemoryConsolidator:
+    """Applies the retention rules to a slice of users and servers per run.
+    
+    A cursor per collection remembers where the last run stopped, so each
+    run costs the same however many records there are. Records are read
+    without being pulled into the memory cache, and only the ones that
+    change are written back.
+    """
+    
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.cursors = {'users': None, 'servers': None}
+        self.stats = Counter()
+        
+    @staticmethod
+    def record_size(data: dict) -> int:
+        return len(json.dumps(data, separators=(',', ':'), default=json_default))
+        
+    def consolidate_user(self, user_id: str, user_data: dict, now: datetime.datetime) -> bool:
+        """Apply the retention rules to a user in place; returns False if the user should be forgotten"""
+        if (
+            RETENTION_DORMANT_DAYS > 0
+            and user_data.get('relationship_level') in RETENTION_DORMANT_LEVELS
+            and is_older_than(user_data.get('last_seen'), now - datetime.timedelta(days=RETENTION_DORMANT_DAYS))
+        ):
+            return False
+            
+        # Old interactions only live on in the summary
+        interactions = user_data.get('successful_interactions', [])
+        cutoff = now - datetime.timedelta(days=RETENTION_INTERACTION_DAYS)
+        old = [entry for entry in interactions if is_older_than(entry.get('timestamp'), cutoff)]
+        overflow = max(len(interactions) - len(old) - RETENTION_MAX_INTERACTIONS, 0)
+        if old or overflow:
+            kept = [entry for entry in interactions if not is_older_than(entry.get('timestamp'), cutoff)]
+            summarize_interactions(user_data, old + kept[:overflow])
+            user_data['successful_interactions'] = kept[overflow:]
+            self.stats['interactions_summarized'] += len(old) + overflow
+            
+        custom_memories = user_data.get('custom_memories', [])
+        if len(custom_memories) > RETENTION_MAX_CUSTOM_MEMORIES:
+            self.stats['custom_memories_dropped'] += len(custom_memories) - RETENTION_MAX_CUSTOM_MEMORIES
+            user_data['custom_memories'] = custom_memories[-RETENTION_MAX_CUSTOM_MEMORIES:]
+            memory_retriever.forget(user_id)
+            
+        servers_shared = user_data.get('servers_shared', [])
+        if len(servers_shared) > RETENTION_MAX_SERVERS_SHARED:
+            self.stats['servers_shared_dropped'] += len(servers_shared) - RETENTION_MAX_SERVERS_SHARED
+            user_data['servers_shared'] = servers_shared[-RETENTION_MAX_SERVERS_SHARED:]
+        return True
+        
+    def consolidate_server(self, server_id: str, server_data: dict, now: datetime.datetime) -> bool:
+        """Returns False for a dormant server the bot is no longer in"""
+        guild_id = int(server_id)
+        return not (
+            RETENTION_DORMANT_DAYS > 0
+            and runs_guild_shard(guild_id)
+            and bot.get_guild(guild_id) is None
+            and is_older_than(server_data.get('last_active'), now - datetime.timedelta(days=RETENTION_DORMANT_DAYS))
+        )
+        
+    async def consolidate_personality(self, now: datetime.datetime):
+        """Drop old mood history"""
+        async with memory.lock('state', 'personality'):
+            personality = memory.get_personality()
+            if 'mood_history' in personality:
+                before = self.record_size(personality)
+                cutoff = now - datetime.timedelta(days=RETENTION_MOOD_HISTORY_DAYS)
+                personality['mood_history'] = [
+                    entry for entry in personality['mood_history']
+                    if not is_older_than(entry['timestamp'], cutoff)
+                ]
+                self.stats['bytes_reclaimed'] += before - self.record_size(personality)
+                memory.save_personality(personality)
+                
+    async def step(self):
+        """Consolidate the next slice of each collection"""
+        now = datetime.datetime.now()
+        for collection in ('users', 'servers'):
+            # Records still in the write-back cache have to reach the backend to be scanned
+            await memory.wait_for_writer()
+            memory.flush_collection(collection)
+            keys = memory.backend.scan_keys(collection, self.cursors[collection], self.batch_size)
+            for key in keys:
+                # Deletions go straight to the writer, so hold back while it's behind
+                await memory.wait_for_writer()
+                async with memory.lock(collection, key):
+                    data = memory.read_record(collection, key)
+                    if data is None:
+                        continue
+                    self.stats['records_scanned'] += 1
+                    before = self.record_size(data)
+                    
+                    if collection == 'users':
+                        keep = self.consolidate_user(key, data, now)
+                    else:
+                        keep = self.consolidate_server(key, data, now)
+                        
+                    if not keep:
+                        memory.delete_record(collection, key)
+                        self.stats[f'{collection}_evicted'] += 1
+                        self.stats['bytes_reclaimed'] += before
+                        continue
+                        
+                    after = self.record_size(data)
+                    if after != before:
+                        memory.put_record(collection, key, data)
+                        self.stats['bytes_reclaimed'] += before - after
+                        
+            # A short slice means the end was reached: start over next time
+            if len(keys) < self.batch_size:
+                self.cursors[collection] = None
+                self.stats[f'{collection}_passes'] += 1
+                if collection == 'users':
+                    await self.consolidate_personality(now)
+            else:
+                self.cursors[collection] = keys[-1]
+
+memory_consolidator = MemoryConsolidator(CONSOLIDATION_BATCH)
+
+@tasks.loop(seconds=CONSOLIDATION_INTERVAL)
 async def memory_consolidation():
-    """Consolidate and clean up memory"""
-    # Clean old mood history
-    personality = memory.get_personality()
-    if 'mood_history' in personality:
-        # Keep only last 30 days
-        cutoff = datetime.datetime.now() - datetime.timedelta(days=30)
-        personality['mood_history'] = [
-            entry for entry in personality['mood_history']
-            if datetime.datetime.fromisoformat(entry['timestamp']) > cutoff
-        ]
-        memory.save_personality(personality)
+    """Consolidate and clean up memory, one slice of records per run"""
+    if not leadership.is_leader:
+        return
+    with metrics.task_timer('memory_consolidation'):
+        await memory_consolidator.step()
+
+@tasks.loop(seconds=5)
+async def memory_flush():
+    """Write dirty memory records back to disk"""
+    with metrics.task_timer('memory_flush'):
+        if memory.needs_flush():
+            # Disk falling behind: keep the records here, where they go on coalescing
+            await memory.wait_for_writer()
+            memory.flush()
+        memory.expire()
+
+@tasks.loop(seconds=30)
+async def storage_compaction():
+    """Let the storage backend fold its journal into a snapshot"""
+    if leadership.is_leader and memory.backend.needs_compaction():
+        with metrics.task_timer('storage_compaction'):
+            await memory.backend.compact()
+
+@tasks.loop(seconds=LEADER_LEASE_SECONDS / 3)
+async def leader_election():
+    """Keep the leader lease, or pick it up when the leader goes away"""
+    leadership.renew()
+
+def collect_metrics():
+    """Copy the components' own counters and sizes into the metrics registry"""
+    for reason, count in response_gate.stats.items():
+        metrics.set_counter('prefilter_messages_total', count, outcome=reason)
+    for name, count in message_debouncer.stats.items():
+        metrics.set_counter('debounce_total', count, kind=name)
+    for name, count in decision_batcher.stats.items():
+        metrics.set_counter('decision_batch_total', count, kind=name)
+    for name, count in gemini.stats.items():
+        metrics.set_counter('gemini_scheduler_total', count, event=name)
+    for name, count in memory_consolidator.stats.items():
+        metrics.set_counter('memory_consolidation_total', count, event=name)
+    for name, count in behavior_scheduler.stats.items():
+        metrics.set_counter('behavior_scheduler_total', count, event=name)
+    metrics.gauge('behavior_scheduler_targets', len(behavior_scheduler.due))
+        
+    if memory.writer:
+        for name, count in memory.writer.stats.items():
+            metrics.set_counter('storage_writer_total', count, event=name)
+        metrics.gauge('storage_writer_pending', memory.writer.pending_count)
+    metrics.gauge('event_loop_lag_max_seconds', loop_lag_monitor.max_lag)
+    
+    metrics.gauge('response_cache_entries', len(response_cache.entries))
+    metrics.gauge('response_cache_bytes', response_cache.size)
+    
+    metrics.gauge('gemini_in_flight', gemini.in_flight)
+    metrics.gauge('gemini_queued', sum(gemini.queued.values()))
+    metrics.gauge('gemini_breaker_open', 0 if gemini.breaker.state == 'closed' else 1)
+    metrics.gauge('memory_dirty_records', memory.dirty_count())
+    for name, value in memory.indexes.stats().items():
+        metrics.gauge('memory_index_entries', value, index=name)
+    for collection, records in memory.cache.items():
+        metrics.gauge('memory_cached_records', len(records), collection=collection)
+    for name, value in conversation_buffer.stats().items():
+        metrics.gauge('conversation_buffer', value, kind=name)
+    for name, value in memory_retriever.stats().items():
+        metrics.gauge('memory_retriever', value, kind=name)
+
+@tasks.loop(seconds=METRICS_EXPORT_INTERVAL)
+async def export_metrics():
+    """Write the metrics textfile for node exporter"""
+    if not METRICS_FILE:
+        return
+    collect_metrics()
+    try:
+        metrics.write_file(METRICS_FILE)
+    except OSError as e:
+        print(f'⚠️ Could not write metrics file: {e}')
 
 # Commands
 @bot.command(name='mood')
@@ -524,17 +3838,19 @@ async def mood_command(ctx):
 async def remember_command(ctx, *, info):
     """Remember something about the user"""
     user_id = str(ctx.author.id)
-    user_data = memory.get_user_memory(user_id)
-    
-    if 'custom_memories' not in user_data:
-        user_data['custom_memories'] = []
-    
-    user_data['custom_memories'].append({
-        'info': info,
-        'timestamp': datetime.datetime.now().isoformat()
-    })
-    
-    memory.save_user_memory(user_id, user_data)
+    async with memory.lock('users', user_id):
+        user_data = memory.get_user_memory(user_id)
+        
+        if 'custom_memories' not in user_data:
+            user_data['custom_memories'] = []
+        
+        user_data['custom_memories'].append({
+            'info': info,
+            'timestamp': datetime.datetime.now().isoformat()
+        })
+        memory_retriever.add(user_id, info)
+        
+        memory.save_user_memory(user_id, user_data)
     
     responses = [
         "got it, filed away in my memory",
@@ -598,11 +3914,191 @@ async def server_data_command(ctx):
         name="📊 Server Info",
         value=f"Culture: {server_data.get('culture', 'unknown')}\n"
               f"My role: {server_data.get('my_role_here', 'observer')}\n"
-              f"Members: {server_data.get('member_count', 0)}",
+              f"Members: {server_data.get('member_count', 0)}\n"
+              f"People I know here: {len(memory.users_in_guild(server_id))}",
         inline=False
     )
     
     await ctx.send(embed=embed)
 
+@bot.command(name='stats')
+@commands.is_owner()
+async def stats_command(ctx):
+    """Show performance counters (owner only)"""
+    collect_metrics()
+    
+    gate_stats = response_gate.stats
+    lines = [
+        f"pre-filter: {response_gate.llm_calls_saved()} llm calls saved, {gate_stats['passed']} sent to llm",
+    ]
+    for reason, count in gate_stats.most_common():
+        if reason != 'passed':
+            lines.append(f"  {reason}: {count}")
+    
+    debounce_stats = message_debouncer.stats
+    if debounce_stats['turns']:
+        lines.append(f"merged turns: {debounce_stats['messages']} messages answered as {debounce_stats['turns']} turns")
+    
+    batch_stats = decision_batcher.stats
+    if batch_stats['batches']:
+        lines.append(
+            f"decision batches: {batch_stats['batches']} batches, {batch_stats['messages']} messages, "
+            f"{batch_stats['llm_calls']} llm calls, {batch_stats['replies']} replies"
+        )
+    
+    gemini_stats = gemini.stats
+    lines.append(
+        f"gemini: {gemini.in_flight} in flight, {sum(gemini.queued.values())} queued, "
+        f"breaker {gemini.breaker.state} ({gemini.breaker.trips} trips, "
+        f"{gemini_stats['breaker_rejected']} calls skipped)"
+    )
+    for name in PRIORITY_NAMES.values():
+        dropped = gemini_stats[f'shed_{name}'] + gemini_stats[f'rejected_{name}'] + gemini_stats[f'expired_{name}']
+        tokens = (
+            metrics.counters[('llm_prompt_tokens_estimate_total', (('priority', name),))]
+            + metrics.counters[('llm_output_tokens_estimate_total', (('priority', name),))]
+        )
+        lines.append(
+            f"  {name}: {gemini_stats[f'requests_{name}']} requests, {dropped} dropped, ~{tokens:.0f} tokens"
+        )
+    
+    for collection in ('users', 'servers', 'state'):
+        hits = metrics.counters[('memory_cache_hits_total', (('collection', collection),))]
+        misses = metrics.counters[('memory_cache_misses_total', (('collection', collection),))]
+        if hits or misses:
+            lines.append(f"memory cache ({collection}): {hits / (hits + misses):.1%} hits of {hits + misses:.0f}")
+    
+    cache_stats = response_cache.stats
+    cache_lines = []
+    for kind in RESPONSE_CACHE_TTLS:
+        hits, misses, coalesced = (cache_stats[f'{outcome}_{kind}'] for outcome in ('hit', 'miss', 'coalesced'))
+        if hits or misses or coalesced:
+            cache_lines.append(f"  {kind}: {hits} hits, {misses} misses, {coalesced} shared in flight")
+    if cache_lines:
+        lines.append(
+            f"response cache: {len(response_cache.entries)} entries, ~{response_cache.size / 1024:.0f} KiB, "
+            f"{cache_stats['evicted']} evicted"
+        )
+        lines.extend(cache_lines)
+        
+    prompt_lines = []
+    for kind in PROMPT_BUDGETS:
+        count = metrics.counters[('prompts_total', (('kind', kind),))]
+        if count:
+            chars = metrics.counters[('prompt_chars_total', (('kind', kind),))]
+            trimmed = metrics.counters[('prompts_trimmed_total', (('kind', kind),))]
+            shortened = metrics.counters[('prompts_over_budget_total', (('kind', kind),))]
+            prompt_lines.append(
+                f"  {kind}: {count:.0f} prompts, ~{chars / count:.0f} chars avg, {trimmed:.0f} trimmed, "
+                f"{shortened:.0f} shortened"
+            )
+    if prompt_lines:
+        lines.append("prompts:")
+        lines.extend(prompt_lines)
+        
+    consolidation_stats = memory_consolidator.stats
+    if consolidation_stats['records_scanned']:
+        lines.append(
+            f"consolidation: {consolidation_stats['records_scanned']} records scanned, "
+            f"{consolidation_stats['users_evicted']} users and {consolidation_stats['servers_evicted']} servers forgotten, "
+            f"{consolidation_stats['interactions_summarized']} interactions summarized, "
+            f"~{consolidation_stats['bytes_reclaimed'] / 1024:.0f} KiB reclaimed"
+        )
+        
+    if memory.writer:
+        writer_stats = memory.writer.stats
+        lines.append(
+            f"storage writer: {memory.writer.pending_count} changes waiting, {writer_stats['writes']} writes, "
+            f"{writer_stats['coalesced']} coalesced, {writer_stats['blocked']} times blocked, {writer_stats['errors']} errors"
+        )
+    lines.append(f"event loop: longest stall {loop_lag_monitor.max_lag * 1000:.0f}ms")
+    
+    scheduler_stats = behavior_scheduler.stats
+    lines.append(
+        f"behavior scheduler: {len(behavior_scheduler.due)} targets, {scheduler_stats['wakeups']} wakeups, "
+        f"{scheduler_stats['mood_checks']} mood checks ({scheduler_stats['mood_skipped_idle']} skipped idle), "
+        f"{scheduler_stats['outreach']} conversations started ({scheduler_stats['outreach_deferred']} deferred)"
+    )
+    
+    buffer_stats = conversation_buffer.stats()
+    lines.append(
+        f"conversation buffer: {buffer_stats['channels']} channels, {buffer_stats['messages']} messages, "
+        f"~{buffer_stats['bytes'] / 1024:.0f} KiB (cap {CONTEXT_MAX_BYTES / 1024:.0f} KiB), "
+        f"{buffer_stats['evicted_channels']} channels evicted"
+    )
+    
+    lines.append("latency (count, p50, p99):")
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        label = ', '.join(str(value) for _, value in labels)
+        lines.append(
+            f"  {name.replace('_seconds', '')} {label}: {histogram.count}, "
+            f"{histogram.quantile(0.5) * 1000:.0f}ms, {histogram.quantile(0.99) * 1000:.0f}ms"
+        )
+    
+    # Discord messages are capped at 2000 characters
+    chunk = []
+    for line in lines:
+        if sum(len(existing) + 1 for existing in chunk) + len(line) > 1900:
+            await ctx.send("```\n" + "\n".join(chunk) + "\n```")
+            chunk = []
+        chunk.append(line)
+    await ctx.send("```\n" + "\n".join(chunk) + "\n```")
+
+def handle_sigterm(signum, frame):
+    """Exit cleanly so pending memory gets flushed"""
+    sys.exit(0)
+
+def run_workers(count: int) -> int:
+    """Launcher: run the bot as several worker processes sharing the shards, until one stops"""
+    if STORAGE_BACKEND != 'sqlite':
+        print('❌ Several workers need the shared SQLite storage: set MINDCORD_STORAGE=sqlite')
+        return 1
+        
+    # Workers open their own connections; the JSON import already ran here
+    memory.close()
+    
+    shard_count = SHARD_COUNT or count
+    count = min(count, shard_count)
+    metrics_root, metrics_ext = os.path.splitext(METRICS_FILE)
+    workers = []
+    for index in range(count):
+        env = dict(
+            os.environ,
+            MINDCORD_WORKERS='1',
+            MINDCORD_WORKER_INDEX=str(index),
+            MINDCORD_SHARD_COUNT=str(shard_count),
+            MINDCORD_SHARD_IDS=','.join(str(shard) for shard in range(index, shard_count, count)),
+            MINDCORD_SHARED_STORAGE='1',
+            # The Gemini quota belongs to the API key, so each worker gets its share
+            MINDCORD_GEMINI_RPM=str(GEMINI_REQUESTS_PER_MINUTE / count),
+            MINDCORD_GEMINI_BURST=str(max(1, GEMINI_BURST // count)),
+            MINDCORD_GEMINI_CONCURRENCY=str(max(1, GEMINI_MAX_CONCURRENCY // count))
+        )
+        if METRICS_FILE:
+            env['MINDCORD_METRICS_FILE'] = f'{metrics_root}.worker{index}{metrics_ext}'
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    print(f'🚀 Started {count} workers for {shard_count} shards')
+    
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    # One worker going down takes the rest with it, so the platform restarts them together
+    while all(worker.poll() is None for worker in workers):
+        time.sleep(1)
+    stop(None, None)
+    return 0 if all(worker.wait() == 0 for worker in workers) else 1
+
 if __name__ == "__main__":
-    bot.run(TOKEN)
\ No newline at end of file
+    memory = MindcordMemory()
+    if WORKERS > 1:
+        sys.exit(run_workers(WORKERS))
+        
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        bot.run(TOKEN)
+    finally:
+        memory.close()
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""Convert Mindcord's binary memory snapshot to and from the JSON layout.
+
+The journal storage mode (MINDCORD_STORAGE=journal) keeps memory in
+snapshot.bin plus journal.jsonl. These commands read and write them without
+starting the bot. Examples:
+
+    python snapshot_tool.py info mindcord_data
+    python snapshot_tool.py to-json mindcord_data /tmp/mindcord_json
+    python snapshot_tool.py from-json old_mindcord_data new_mindcord_data
+
+to-json includes changes still in the journal, and writes users.json,
+servers.json and personality.json in the layout of the json storage mode.
+"""
+import argparse
+import json
+import os
+import sys
+
+# Importing main opens no storage (its memory layer starts with the bot), so
+# this is safe to run next to a live bot without touching its journal
+from main import JournalBackend, JsonBackend, SnapshotFile, read_journal
+
+def load_all(data_dir: str) -> dict:
+    """Every record in a journal-mode data directory, as collection -> {key: record}"""
+    records = {collection: {} for collection in SnapshotFile.COLLECTIONS}
+    snapshot_path = os.path.join(data_dir, JournalBackend.SNAPSHOT_FILE)
+    journals = [JournalBackend.ROTATED_FILE, JournalBackend.JOURNAL_FILE]
+    if os.path.exists(snapshot_path):
+        snapshot = SnapshotFile(snapshot_path)
+        try:
+            for collection, key, data in snapshot.records():
+                records[collection][key] = data
+        finally:
+            snapshot.close()
+    else:
+        journals.insert(0, JournalBackend.LEGACY_SNAPSHOT_FILE)
+
+    for filename in journals:
+        for collection, key, data in read_journal(os.path.join(data_dir, filename)):
+            if data is None:
+                records[collection].pop(key, None)
+            else:
+                records[collection][key] = data
+    return records
+
+def info(args) -> int:
+    records = load_all(args.data_dir)
+    for filename in (JournalBackend.SNAPSHOT_FILE, JournalBackend.JOURNAL_FILE, JournalBackend.ROTATED_FILE):
+        path = os.path.join(args.data_dir, filename)
+        if os.path.exists(path):
+            print(f'{filename}: {os.path.getsize(path) / 1024:.1f} KiB')
+    for collection, items in records.items():
+        print(f'{collection}: {len(items)} records')
+    return 0
+
+def to_json(args) -> int:
+    records = load_all(args.data_dir)
+    os.makedirs(args.out_dir, exist_ok=True)
+    target = JsonBackend(args.out_dir)
+    target.save_json('users.json', records['users'])
+    target.save_json('servers.json', records['servers'])
+    for key, data in records['state'].items():
+        target.save_json(f'{key}.json', data)
+    print(f"Wrote {len(records['users'])} users, {len(records['servers'])} servers "
+          f"and {len(records['state'])} state files to {args.out_dir}")
+    return 0
+
+def from_json(args) -> int:
+    existing = [
+        filename for filename in (JournalBackend.SNAPSHOT_FILE, JournalBackend.JOURNAL_FILE, JournalBackend.ROTATED_FILE)
+        if os.path.exists(os.path.join(args.data_dir, filename))
+    ]
+    if existing and not args.force:
+        print(f"{args.data_dir} already has {', '.join(existing)}; use --force to replace them", file=sys.stderr)
+        return 1
+
+    source = JsonBackend(args.json_dir)
+    records = [
+        (collection, key, json.dumps(data, separators=(',', ':'), default=str).encode())
+        for collection in ('users', 'servers')
+        for key, data in source.load_file(collection).items()
+    ]
+    personality = source.load_record('state', 'personality')
+    if personality:
+        records.append(('state', 'personality', json.dumps(personality, separators=(',', ':'), default=str).encode()))
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    snapshot_path = os.path.join(args.data_dir, JournalBackend.SNAPSHOT_FILE)
+    SnapshotFile.write(f'{snapshot_path}.tmp', records)
+    os.replace(f'{snapshot_path}.tmp', snapshot_path)
+    for filename in existing:
+        if filename != JournalBackend.SNAPSHOT_FILE:
+            os.remove(os.path.join(args.data_dir, filename))
+    print(f'Wrote {len(records)} records to {snapshot_path}')
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_info = subparsers.add_parser('info', help='show record counts and file sizes')
+    parser_info.add_argument('data_dir')
+    parser_info.set_defaults(func=info)
+
+    parser_to_json = subparsers.add_parser('to-json', help='export snapshot and journal as JSON files')
+    parser_to_json.add_argument('data_dir')
+    parser_to_json.add_argument('out_dir')
+    parser_to_json.set_defaults(func=to_json)
+
+    parser_from_json = subparsers.add_parser('from-json', help='build a snapshot from JSON files')
+    parser_from_json.add_argument('json_dir')
+    parser_from_json.add_argument('data_dir')
+    parser_from_json.add_argument('--force', action='store_true', help='replace an existing snapshot and journal')
+    parser_from_json.set_defaults(func=from_json)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(args.func(args))
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""BehaviorScheduler: one live heap entry per target, however often it's rescheduled"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import main
+
+def message(user_id):
+    return SimpleNamespace(author=SimpleNamespace(id=user_id))
+
+def friends(monkeypatch, count):
+    levels = {str(user_id): 'friend' for user_id in range(count)}
+    monkeypatch.setattr(main, 'memory', SimpleNamespace(indexes=SimpleNamespace(user_levels=levels)))
+
+def test_heap_stays_bounded_under_activity(monkeypatch):
+    friends(monkeypatch, 5)
+    scheduler = main.BehaviorScheduler(0.1)
+    for turn in range(10000):
+        scheduler.activity(message(turn % 5))
+        assert len(scheduler.heap) <= 2 * len(scheduler.due) + 16
+    # The five friends, plus the mood check all that chatter brought forward
+    assert len(scheduler.due) == 6 and scheduler.MOOD in scheduler.due
+    # Every target still has exactly one live entry, at its current due time
+    live = [(when, target) for when, token, target in scheduler.heap if scheduler.tokens[target] == token]
+    assert sorted(live) == sorted((when, target) for target, when in scheduler.due.items())
+    assert scheduler.stats['heap_compactions'] > 0
+
+def test_run_fires_each_target_once_at_its_latest_time(monkeypatch):
+    friends(monkeypatch, 0)
+
+    async def scenario():
+        scheduler = main.BehaviorScheduler(0)
+        fired = []
+
+        async def fire(target):
+            fired.append((target, time.monotonic()))
+
+        scheduler.fire = fire
+        now = time.monotonic()
+        scheduler.set_due(('outreach', 'a'), now + 0.02)
+        scheduler.set_due(('outreach', 'b'), now + 0.04)
+        # Pushed back, brought forward, pushed back again
+        scheduler.set_due(('outreach', 'a'), now + 0.2)
+        scheduler.set_due(('outreach', 'a'), now + 0.01)
+        scheduler.set_due(('outreach', 'a'), now + 0.08)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.15)
+        task.cancel()
+        assert [target for target, _ in fired] == [('outreach', 'b'), ('outreach', 'a')]
+        assert fired[1][1] >= now + 0.08
+        assert not scheduler.due and not scheduler.tokens
+        # Only the superseded entry for +0.2 is left, and it won't fire
+        assert [token for _, token, _ in scheduler.heap] == [2]
+
+    asyncio.run(scenario())
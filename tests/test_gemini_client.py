@@ -0,0 +1,148 @@
+"""GeminiClient scheduling: slots are always given back, whatever happens to the request"""
+import asyncio
+
+import pytest
+
+import main
+
+class StubModel:
+    """Answers after a delay, or waits until released; tracks how many calls run at once"""
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.running = 0
+        self.most_running = 0
+        self.release = None
+        self.order = []
+
+    async def generate_content_async(self, prompt, **kwargs):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            if self.release is not None:
+                await self.release.wait()
+            await asyncio.sleep(self.delay)
+            self.order.append(prompt)
+            return type('Response', (), {'text': f'answer to {prompt}'})()
+        finally:
+            self.running -= 1
+
+def client(model, concurrency=2, timeout=5.0, rpm=0, burst=5):
+    return main.GeminiClient(model, concurrency, timeout, rpm, burst, 100)
+
+def settled(gemini):
+    """Nothing held or waiting"""
+    return gemini.in_flight == 0 and sum(gemini.queued.values()) == 0
+
+def test_concurrency_cap_and_priority_order():
+    async def scenario():
+        model = StubModel()
+        model.release = asyncio.Event()
+        gemini = client(model, concurrency=1)
+        first = asyncio.create_task(gemini.generate('first', main.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.01)
+        # Queued behind the first call: the mention goes before the earlier background request
+        background = asyncio.create_task(gemini.generate('background', main.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        mention = asyncio.create_task(gemini.generate('mention', main.PRIORITY_MENTION))
+        await asyncio.sleep(0.01)
+        model.release.set()
+        await asyncio.gather(first, background, mention)
+        return model, gemini
+
+    model, gemini = asyncio.run(scenario())
+    assert model.most_running == 1
+    assert model.order == ['first', 'mention', 'background']
+    assert settled(gemini)
+
+def test_cancelled_while_queued_gives_nothing_back_twice():
+    async def scenario():
+        model = StubModel()
+        model.release = asyncio.Event()
+        gemini = client(model, concurrency=1)
+        running = asyncio.create_task(gemini.generate('running', main.PRIORITY_DM))
+        await asyncio.sleep(0.01)
+        queued = asyncio.create_task(gemini.generate('queued', main.PRIORITY_DM))
+        await asyncio.sleep(0.01)
+        assert gemini.queued[main.PRIORITY_DM] == 1
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        model.release.set()
+        await running
+        # The slot is free again for the next request
+        await gemini.generate('next', main.PRIORITY_DM)
+        return model, gemini
+
+    model, gemini = asyncio.run(scenario())
+    assert model.order == ['running', 'next']
+    assert settled(gemini)
+
+def test_cancelled_while_running_releases_its_slot():
+    async def scenario():
+        model = StubModel()
+        model.release = asyncio.Event()
+        gemini = client(model, concurrency=1)
+        call = asyncio.create_task(gemini.generate('slow', main.PRIORITY_DM))
+        await asyncio.sleep(0.01)
+        assert gemini.in_flight == 1
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert settled(gemini)
+    # Being cancelled says nothing about Gemini's health
+    assert gemini.breaker.state == 'closed' and not gemini.breaker.results
+
+def test_waiting_too_long_for_a_slot_is_shed():
+    async def scenario():
+        model = StubModel()
+        model.release = asyncio.Event()
+        gemini = client(model, concurrency=1, timeout=0.1)
+        running = asyncio.create_task(gemini.generate('running', main.PRIORITY_DM, timeout=5))
+        await asyncio.sleep(0.01)
+        with pytest.raises(main.GeminiOverloaded):
+            await gemini.generate('waits', main.PRIORITY_REPLY)
+        model.release.set()
+        await running
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert gemini.stats['expired_reply'] == 1
+    assert settled(gemini)
+
+def test_model_timeout_releases_the_slot_and_counts_as_failure():
+    async def scenario():
+        model = StubModel()
+        model.release = asyncio.Event()
+        gemini = client(model, concurrency=1)
+        with pytest.raises(asyncio.TimeoutError):
+            await gemini.generate('hangs', main.PRIORITY_DM, timeout=0.05)
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert settled(gemini)
+    assert [ok for ok, _ in gemini.breaker.results] == [False]
+
+def test_full_queue_rejects_without_taking_a_slot(monkeypatch):
+    monkeypatch.setitem(main.GEMINI_QUEUE_LIMITS, main.PRIORITY_BACKGROUND, 1)
+
+    async def scenario():
+        model = StubModel()
+        model.release = asyncio.Event()
+        gemini = client(model, concurrency=1)
+        running = asyncio.create_task(gemini.generate('running', main.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.01)
+        queued = asyncio.create_task(gemini.generate('queued', main.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.01)
+        with pytest.raises(main.GeminiOverloaded):
+            await gemini.generate('rejected', main.PRIORITY_BACKGROUND)
+        model.release.set()
+        await asyncio.gather(running, queued)
+        return gemini
+
+    gemini = asyncio.run(scenario())
+    assert gemini.stats['rejected_background'] == 1
+    assert settled(gemini)
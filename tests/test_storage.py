@@ -0,0 +1,168 @@
+"""Storage backends: records survive a restart, and a crash mid-write loses at most the change being written"""
+import os
+
+import pytest
+
+import main
+
+BACKENDS = ['json', 'sqlite', 'journal']
+
+def open_backend(data_dir, kind):
+    return main.create_backend(str(data_dir), kind)
+
+def user(name, level='new', servers=()):
+    return {'name': name, 'relationship_level': level, 'servers_shared': list(servers), 'total_interactions': 1}
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_records_survive_reopen(tmp_path, kind):
+    backend = open_backend(tmp_path, kind)
+    backend.save_records('users', {'1': user('a', 'friend', ['10']), '2': user('b'), '3': user('c')})
+    backend.save_records('servers', {'10': {'name': 'guild'}})
+    backend.save_records('state', {'personality': {'main_mood': 'chill'}})
+    backend.save_records('users', {'2': user('b2', 'close_friend')})
+    backend.delete_records('users', ['3'])
+    backend.close()
+
+    backend = open_backend(tmp_path, kind)
+    try:
+        assert backend.load_record('users', '1') == user('a', 'friend', ['10'])
+        assert backend.load_record('users', '2') == user('b2', 'close_friend')
+        assert backend.load_record('users', '3') is None
+        assert backend.load_record('servers', '10') == {'name': 'guild'}
+        assert backend.load_record('state', 'personality') == {'main_mood': 'chill'}
+        assert sorted(backend.find_keys('users', 'relationship_level', ['friend', 'close_friend'])) == ['1', '2']
+        assert backend.scan_keys('users', None, 1) == ['1']
+        assert backend.scan_keys('users', '1', 10) == ['2']
+        assert dict(backend.scan_fields('users', ['relationship_level'])) == {'1': ['friend'], '2': ['close_friend']}
+    finally:
+        backend.close()
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_writes_through_writer_thread_survive_reopen(tmp_path, kind):
+    memory = main.MindcordMemory(str(tmp_path), open_backend(tmp_path, kind), background_writes=True)
+    for i in range(50):
+        memory.save_user_memory(str(i % 5), user(f'name{i}'))
+        memory.flush()
+    memory.close()
+
+    backend = open_backend(tmp_path, kind)
+    try:
+        assert {key: backend.load_record('users', key)['name'] for key in map(str, range(5))} == {
+            str(i): f'name{45 + i}' for i in range(5)
+        }
+    finally:
+        backend.close()
+
+def test_json_ignores_half_written_temp_file(tmp_path):
+    backend = open_backend(tmp_path, 'json')
+    backend.save_records('users', {'1': user('a')})
+    backend.close()
+    # Crash while replacing users.json: the temporary copy is cut short
+    with open(tmp_path / 'users.json.tmp', 'w') as f:
+        f.write('{"1": {"name": "tor')
+
+    backend = open_backend(tmp_path, 'json')
+    try:
+        assert backend.load_record('users', '1') == user('a')
+    finally:
+        backend.close()
+
+def test_sqlite_keeps_committed_writes_without_close(tmp_path):
+    backend = open_backend(tmp_path, 'sqlite')
+    backend.save_records('users', {'1': user('a')})
+    # No close(): the process died, but the write was committed
+
+    reopened = open_backend(tmp_path, 'sqlite')
+    try:
+        assert reopened.load_record('users', '1') == user('a')
+    finally:
+        reopened.close()
+        backend.close()
+
+def test_journal_trims_torn_tail_before_appending(tmp_path):
+    backend = open_backend(tmp_path, 'journal')
+    backend.save_records('users', {'1': user('a')})
+    backend.close()
+    with open(tmp_path / main.JournalBackend.JOURNAL_FILE, 'a') as f:
+        f.write('{"c":"users","k":"2","v":{"na')
+
+    backend = open_backend(tmp_path, 'journal')
+    backend.save_records('users', {'4': user('d')})
+    backend.close()
+
+    backend = open_backend(tmp_path, 'journal')
+    try:
+        assert sorted(backend.records['users']) == ['1', '4']
+        assert backend.load_record('users', '4') == user('d')
+    finally:
+        backend.close()
+
+def test_journal_skips_and_reports_a_bad_line_in_the_middle(tmp_path, capsys):
+    backend = open_backend(tmp_path, 'journal')
+    backend.save_records('users', {'1': user('a')})
+    backend.close()
+    with open(tmp_path / main.JournalBackend.JOURNAL_FILE, 'a') as f:
+        f.write('not json\n')
+    backend = open_backend(tmp_path, 'journal')
+    backend.save_records('users', {'2': user('b')})
+    backend.close()
+
+    backend = open_backend(tmp_path, 'journal')
+    try:
+        assert sorted(backend.records['users']) == ['1', '2']
+    finally:
+        backend.close()
+    assert 'Skipping unreadable line 2' in capsys.readouterr().out
+
+def test_journal_compaction_keeps_every_record(tmp_path):
+    backend = open_backend(tmp_path, 'journal')
+    backend.save_records('users', {str(i): user(f'v1-{i}') for i in range(20)})
+    backend.compact_now()
+    # After compaction: one change and one deletion on top of the snapshot
+    backend.save_records('users', {'3': user('v2-3')})
+    backend.delete_records('users', ['4'])
+    assert isinstance(backend.records['users']['5'], int)  # served from the snapshot
+    backend.close()
+
+    backend = open_backend(tmp_path, 'journal')
+    try:
+        assert backend.load_record('users', '0') == user('v1-0')
+        assert backend.load_record('users', '3') == user('v2-3')
+        assert backend.load_record('users', '4') is None
+        assert len(backend.records['users']) == 19
+    finally:
+        backend.close()
+
+def test_journal_recovers_from_crash_during_compaction(tmp_path):
+    backend = open_backend(tmp_path, 'journal')
+    backend.save_records('users', {'1': user('a'), '2': user('b')})
+    backend.compact_now()
+    backend.save_records('users', {'2': user('b2')})
+    backend.close()
+    # Crash after rotating the journal, before the new snapshot replaced the old one
+    os.replace(tmp_path / main.JournalBackend.JOURNAL_FILE, tmp_path / main.JournalBackend.ROTATED_FILE)
+    with open(tmp_path / main.JournalBackend.JOURNAL_FILE, 'w') as f:
+        f.write('{"c":"users","k":"3","v":{"name":"c"}}\n')
+
+    backend = open_backend(tmp_path, 'journal')
+    try:
+        assert backend.load_record('users', '1') == user('a')
+        assert backend.load_record('users', '2') == user('b2')
+        assert backend.load_record('users', '3') == {'name': 'c'}
+        # Replaying the rotated journal folds it into a fresh snapshot straight away
+        assert not os.path.exists(tmp_path / main.JournalBackend.ROTATED_FILE)
+    finally:
+        backend.close()
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_scan_keys_follows_saves_and_deletes_between_pages(tmp_path, kind):
+    backend = open_backend(tmp_path, kind)
+    try:
+        backend.save_records('users', {key: user(key) for key in ('b', 'd', 'f')})
+        assert backend.scan_keys('users', None, 2) == ['b', 'd']
+        backend.save_records('users', {'a': user('a'), 'e': user('e'), 'd': user('d2')})
+        backend.delete_records('users', ['f'])
+        assert backend.scan_keys('users', 'd', 10) == ['e']
+        assert backend.scan_keys('users', None, 10) == ['a', 'b', 'd', 'e']
+    finally:
+        backend.close()
@@ -0,0 +1,150 @@
+"""StorageWriter: coalescing, retries, backpressure off the event loop and bounded shutdown"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+
+TARGET = (None, 'users')
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(main.StorageWriter, 'RETRY_DELAY', 0.01)
+
+class Disk:
+    """A write function that records what it was given, and can be held or made to fail"""
+
+    def __init__(self):
+        self.writes = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+        self.failures = 0
+
+    def __call__(self, changes):
+        self.entered.set()
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise OSError('disk full')
+        self.writes.append(dict(changes))
+
+def test_changes_to_one_record_are_written_once():
+    disk = Disk()
+    writer = main.StorageWriter(100)
+    try:
+        # Hold the thread on a first write so the rest pile up behind it
+        disk.gate.clear()
+        writer.submit(TARGET, disk, {'0': 'first'})
+        assert disk.entered.wait(1)
+        for version in range(5):
+            writer.submit(TARGET, disk, {'1': f'v{version}', '2': f'w{version}'})
+        assert writer.pending_count == 3  # '0' being written, '1' and '2' waiting
+        assert writer.pending_change(TARGET, '1') == (True, 'v4')
+        disk.gate.set()
+        assert writer.flush(1)
+    finally:
+        writer.close(1)
+    assert disk.writes == [{'0': 'first'}, {'1': 'v4', '2': 'w4'}]
+    assert writer.stats['coalesced'] == 8
+    assert writer.pending_count == 0
+
+def test_failed_write_is_retried_under_newer_changes():
+    disk = Disk()
+    disk.failures = 1
+    disk.gate.clear()
+    writer = main.StorageWriter(100)
+    try:
+        writer.submit(TARGET, disk, {'1': 'old', '2': 'kept'})
+        assert disk.entered.wait(1)
+        writer.submit(TARGET, disk, {'1': 'new'})
+        disk.gate.set()
+        assert writer.flush(1)
+    finally:
+        writer.close(1)
+    assert disk.writes == [{'1': 'new', '2': 'kept'}]
+    assert writer.stats['errors'] == 1
+    assert writer.pending_count == 0
+
+def test_submit_never_blocks_and_wait_for_room_does_until_drained():
+    disk = Disk()
+    disk.gate.clear()
+    writer = main.StorageWriter(2)
+    try:
+        started = time.monotonic()
+        for key in range(5):
+            writer.submit(TARGET, disk, {str(key): 'x'})
+        assert time.monotonic() - started < 0.5
+        assert not writer.has_room()
+
+        threading.Timer(0.1, disk.gate.set).start()
+        writer.wait_for_room()
+        assert writer.has_room()
+        assert writer.stats['blocked'] == 1
+    finally:
+        disk.gate.set()
+        writer.close(1)
+
+def test_memory_waits_for_the_writer_without_blocking_the_event_loop(tmp_path):
+    memory = main.MindcordMemory(str(tmp_path), main.create_backend(str(tmp_path), 'json'), background_writes=True)
+    memory.writer.max_pending = 1
+    disk = Disk()
+    disk.gate.clear()
+    memory.writer.submit(TARGET, disk, {'1': 'x', '2': 'y'})
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        threading.Timer(0.2, disk.gate.set).start()
+        await memory.wait_for_writer()
+        ticker.cancel()
+        return ticks
+
+    try:
+        assert asyncio.run(run()) >= 5
+    finally:
+        disk.gate.set()
+        memory.close(1)
+
+def test_close_drops_a_write_that_keeps_failing(capsys):
+    disk = Disk()
+    disk.failures = 10 ** 6
+    writer = main.StorageWriter(100, close_retries=3)
+    writer.submit(TARGET, disk, {'1': 'a', '4': 'b'})
+
+    started = time.monotonic()
+    writer.close(5)
+    assert time.monotonic() - started < 2
+    assert not writer.thread.is_alive()
+    assert writer.stats['dropped'] == 2
+    assert writer.pending_count == 0
+    assert '2 changes not written (users: 1, 4)' in capsys.readouterr().out
+
+def test_close_gives_up_on_a_write_that_hangs(capsys):
+    disk = Disk()
+    disk.gate.clear()
+    writer = main.StorageWriter(100)
+    writer.submit(TARGET, disk, {'1': 'a'})
+    assert disk.entered.wait(1)
+
+    started = time.monotonic()
+    writer.close(0.2)
+    assert time.monotonic() - started < 1
+    assert 'Gave up waiting for storage writes, 1 changes not written' in capsys.readouterr().out
+    disk.gate.set()
+    writer.thread.join(1)
+
+def test_submit_after_close_is_refused():
+    writer = main.StorageWriter(100)
+    writer.close(1)
+    with pytest.raises(RuntimeError):
+        writer.submit(TARGET, Disk(), {'1': 'a'})